@@ -6,8 +6,19 @@ from dotenv import load_dotenv
 import asyncio
 import sqlite3
 import json
-from datetime import datetime, timezone, timedelta
-import random
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime, timezone
+import bisect
+import heapq
+import gzip
+import re
+import hashlib
+from types import MappingProxyType
+import casino_rules
 
 # === НАСТРОЙКИ ===
 load_dotenv()
@@ -15,8 +26,11 @@ TOKEN = os.getenv("DISCORD_TOKEN")
 if not TOKEN:
     raise RuntimeError("❌ Файл .env должен содержать DISCORD_TOKEN=ваш_токен")
 OWNER_ID = 1425864152563585158
+# Сырые голосовые сессии старше этого срока уходят в сжатый архив; дневные итоги остаются в БД
+VOICE_RETENTION_DAYS = int(os.getenv("VOICE_RETENTION_DAYS", "90"))
 
 os.makedirs("backups", exist_ok=True)
+os.makedirs("archive", exist_ok=True)
 
 # === НАСТРОЙКА БОТА ===
 intents = discord.Intents.default()
@@ -25,306 +39,1020 @@ intents.members = True
 intents.voice_states = True
 intents.presences = True
 intents.guilds = True
-bot = commands.Bot(command_prefix="!", intents=intents)
-
-# === ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ===
-def init_db():
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
 
+class FamilyBot(commands.Bot):
+    async def setup_hook(self):
+        self.add_dynamic_items(CasinoButton)
+        self.shop_view = ShopView()
+        self.add_view(self.shop_view)
+        voice_writer.start()
+        cooldowns.start()
+        asyncio.create_task(voice_retention_task())
+
+    async def close(self):
+        await super().close()
+        await voice_writer.close()
+        await cooldowns.close()
+        # Всё записано — дожидаемся потока БД и закрываем соединение (WAL сбрасывается в основной файл)
+        adb.shutdown()
+        db.close()
+
+bot = FamilyBot(command_prefix="!", intents=intents)
+
+# === СЛОЙ ДОСТУПА К БД ===
+# Одно долгоживущее соединение на весь процесс вместо connect/close в каждом хелпере.
+# sqlite3 сам кэширует подготовленные выражения по тексту SQL (cached_statements),
+# поэтому повторные запросы из хелперов не компилируются заново.
+DB_PATH = "voice_data.db"
+
+class Database:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute("PRAGMA synchronous = NORMAL")
+        self.conn.execute("PRAGMA cache_size = -16000")  # ~16 МБ страничного кэша
+        self.conn.execute("PRAGMA temp_store = MEMORY")
+        self.conn.execute("PRAGMA busy_timeout = 5000")
+
+    def fetchone(self, sql: str, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchone()
+
+    def fetchall(self, sql: str, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def execute(self, sql: str, params=()) -> int:
+        with self.transaction() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def executemany(self, sql: str, seq) -> int:
+        with self.transaction() as cursor:
+            cursor.executemany(sql, seq)
+            return cursor.rowcount
+
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            cursor = self.conn.cursor()
+            try:
+                yield cursor
+            except BaseException:
+                self.conn.rollback()
+                raise
+            else:
+                self.conn.commit()
+            finally:
+                cursor.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+db = Database(DB_PATH)
+
+# === АСИНХРОННЫЙ ФАСАД БД ===
+# Все запросы выполняются в отдельном потоке БД, чтобы медленный commit не блокировал
+# event loop (heartbeat шлюза и остальные взаимодействия). Поток один, поэтому запросы
+# выполняются строго по очереди отправки. Синхронные хелперы регистрируются через
+# @adb.register и вызываются из корутин как `await adb.get_balance(user_id)`.
+class AsyncDB:
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db")
+        self.helpers = {}
+
+    def register(self, func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await self.run(func, *args, **kwargs)
+        self.helpers[func.__name__] = wrapper
+        return func
+
+    async def run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    def __getattr__(self, name):
+        try:
+            return self.helpers[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+adb = AsyncDB()
+
+# === ВРЕМЯ ===
+# Все отметки времени в БД — целые миллисекунды Unix (UTC), дни в итогах — номер дня от эпохи.
+DAY_MS = 86_400_000
+
+def now_ms() -> int:
+    return time.time_ns() // 1_000_000
+
+def to_ms(dt: datetime) -> int:
+    return int(dt.timestamp() * 1000)
+
+def from_ms(ms: int) -> datetime:
+    return datetime.fromtimestamp(ms / 1000, timezone.utc)
+
+def iso_to_ms(value):
+    # Для миграции со старых ISO-строк; строки без смещения считаются UTC
+    if value is None:
+        return None
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return to_ms(dt)
+
+def split_by_day(start: int, end: int) -> list:
+    # Разбивает интервал по полуночи UTC: [(номер дня, секунд), ...]
+    parts = []
+    while start < end:
+        day = start // DAY_MS
+        piece_end = min(end, (day + 1) * DAY_MS)
+        parts.append((day, (piece_end - start) / 1000))
+        start = piece_end
+    return parts
+
+# === МИГРАЦИИ СХЕМЫ ===
+# Номер применённой миграции хранится в PRAGMA user_version. При старте применяются
+# только новые миграции, каждая в своей транзакции вместе с обновлением версии.
+# Миграция — список SQL-выражений или функция, принимающая курсор.
+# Новые изменения схемы добавляются только в конец списка.
+def migrate_cooldowns(cursor):
+    # Таймер /work переезжает в общую таблицу кулдаунов: хранится время окончания, а не последнего запуска
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS voice_sessions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        channel_id INTEGER NOT NULL,
-        start_time TEXT NOT NULL,
-        end_time TEXT
-    )
+        CREATE TABLE IF NOT EXISTS cooldowns (
+            name TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (name, user_id)
+        ) WITHOUT ROWID
     ''')
-
+    now = time.time()
+    rows = []
+    for user_id, last_work in cursor.execute("SELECT user_id, last_work FROM work_timer WHERE last_work IS NOT NULL").fetchall():
+        expires_at = iso_to_ms(last_work) / 1000 + 300
+        if expires_at > now:
+            rows.append(("work", user_id, expires_at))
+    cursor.executemany("INSERT OR REPLACE INTO cooldowns (name, user_id, expires_at) VALUES (?, ?, ?)", rows)
+    cursor.execute("DROP TABLE work_timer")
+
+def migrate_voice_daily_totals(cursor):
+    # Дневные итоги по (пользователь, день, канал); заполняются по всей истории закрытых сессий.
+    # На этой версии схемы время ещё в ISO-строках, а день — "YYYY-MM-DD"
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS family_blacklist (
-        user_id INTEGER PRIMARY KEY,
-        reason TEXT NOT NULL,
-        added_by INTEGER NOT NULL,
-        added_at TEXT NOT NULL
-    )
+        CREATE TABLE IF NOT EXISTS voice_daily_totals (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            channel_id INTEGER NOT NULL,
+            seconds INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, channel_id)
+        ) WITHOUT ROWID
     ''')
+    totals = {}
+    for user_id, channel_id, start, end in cursor.execute(
+        "SELECT user_id, channel_id, start_time, end_time FROM voice_sessions WHERE end_time IS NOT NULL"
+    ):
+        for day, seconds in split_by_day(iso_to_ms(start), iso_to_ms(end)):
+            key = (user_id, from_ms(day * DAY_MS).date().isoformat(), channel_id)
+            totals[key] = totals.get(key, 0) + seconds
+    cursor.executemany(
+        "INSERT INTO voice_daily_totals (user_id, day, channel_id, seconds) VALUES (?, ?, ?, ?)",
+        [(user_id, day, channel_id, round(seconds)) for (user_id, day, channel_id), seconds in totals.items()]
+    )
 
+def migrate_epoch_ms(cursor):
+    # Столбцы с TEXT-аффинностью превратили бы числа обратно в строки,
+    # поэтому таблицы пересоздаются с INTEGER-столбцами и данные переливаются через iso_to_ms.
+    cursor.connection.create_function("iso_to_ms", 1, iso_to_ms, deterministic=True)
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS applications (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        submitted_at TEXT NOT NULL,
-        status TEXT NOT NULL DEFAULT 'pending'
-    )
+        CREATE TABLE voice_sessions_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            start_time INTEGER NOT NULL,
+            end_time INTEGER
+        )
     ''')
-
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS profiles (
-        user_id INTEGER PRIMARY KEY,
-        nickname TEXT,
-        static_id TEXT
-    )
+        INSERT INTO voice_sessions_new (id, user_id, channel_id, start_time, end_time)
+        SELECT id, user_id, channel_id, iso_to_ms(start_time), iso_to_ms(end_time) FROM voice_sessions
     ''')
-
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS casino_balance (
-        user_id INTEGER PRIMARY KEY,
-        balance INTEGER NOT NULL DEFAULT 10000
-    )
+        CREATE TABLE family_blacklist_new (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT NOT NULL,
+            added_by INTEGER NOT NULL,
+            added_at INTEGER NOT NULL
+        )
     ''')
-
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS work_timer (
-        user_id INTEGER PRIMARY KEY,
-        last_work TEXT
-    )
+        INSERT INTO family_blacklist_new (user_id, reason, added_by, added_at)
+        SELECT user_id, reason, added_by, iso_to_ms(added_at) FROM family_blacklist
     ''')
-
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS casino_ban (
-        user_id INTEGER PRIMARY KEY
-    )
+        CREATE TABLE applications_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            submitted_at INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+        )
     ''')
-
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS white_list (
-        user_id INTEGER PRIMARY KEY
-    )
+        INSERT INTO applications_new (id, user_id, submitted_at, status)
+        SELECT id, user_id, iso_to_ms(submitted_at), status FROM applications
     ''')
-
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS security_violations (
-        user_id INTEGER PRIMARY KEY,
-        strikes INTEGER NOT NULL DEFAULT 0
-    )
+        CREATE TABLE cooldowns_new (
+            name TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            expires_at INTEGER NOT NULL,
+            PRIMARY KEY (name, user_id)
+        ) WITHOUT ROWID
     ''')
-
     cursor.execute('''
-    CREATE TABLE IF NOT EXISTS config (
-        key TEXT PRIMARY KEY,
-        value TEXT
-    )
+        INSERT INTO cooldowns_new (name, user_id, expires_at)
+        SELECT name, user_id, CAST(expires_at * 1000 AS INTEGER) FROM cooldowns
+    ''')
+    cursor.execute('''
+        CREATE TABLE voice_daily_totals_new (
+            user_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            seconds INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, day, channel_id)
+        ) WITHOUT ROWID
+    ''')
+    # "YYYY-MM-DD" -> номер дня от эпохи (юлианский день 2440587.5 — полночь 1970-01-01 UTC)
+    cursor.execute('''
+        INSERT INTO voice_daily_totals_new (user_id, day, channel_id, seconds)
+        SELECT user_id, CAST(julianday(day) - 2440587.5 AS INTEGER), channel_id, seconds FROM voice_daily_totals
     ''')
+    for table in ("voice_sessions", "family_blacklist", "applications", "cooldowns", "voice_daily_totals"):
+        cursor.execute(f"DROP TABLE {table}")
+        cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+    # Индексы удалены вместе со старыми таблицами
+    cursor.execute("CREATE INDEX idx_voice_sessions_open ON voice_sessions (user_id) WHERE end_time IS NULL")
+    cursor.execute("CREATE INDEX idx_voice_sessions_user_start ON voice_sessions (user_id, start_time)")
+    cursor.execute("CREATE INDEX idx_applications_pending ON applications (status) WHERE status = 'pending'")
+    cursor.execute("CREATE INDEX idx_applications_submitted ON applications (submitted_at)")
+    cursor.execute("CREATE INDEX idx_voice_daily_totals_day ON voice_daily_totals (day, user_id, seconds)")
+
+MIGRATIONS = [
+    # 1: базовая схема
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS voice_sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            channel_id INTEGER NOT NULL,
+            start_time TEXT NOT NULL,
+            end_time TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS family_blacklist (
+            user_id INTEGER PRIMARY KEY,
+            reason TEXT NOT NULL,
+            added_by INTEGER NOT NULL,
+            added_at TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS applications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            submitted_at TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending'
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS profiles (
+            user_id INTEGER PRIMARY KEY,
+            nickname TEXT,
+            static_id TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS casino_balance (
+            user_id INTEGER PRIMARY KEY,
+            balance INTEGER NOT NULL DEFAULT 10000
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS work_timer (
+            user_id INTEGER PRIMARY KEY,
+            last_work TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS casino_ban (
+            user_id INTEGER PRIMARY KEY
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS white_list (
+            user_id INTEGER PRIMARY KEY
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS security_violations (
+            user_id INTEGER PRIMARY KEY,
+            strikes INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS config (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''',
+    ],
+    # 2: индексы для горячих запросов
+    [
+        "CREATE INDEX IF NOT EXISTS idx_voice_sessions_open ON voice_sessions (user_id) WHERE end_time IS NULL",
+        "CREATE INDEX IF NOT EXISTS idx_voice_sessions_user_start ON voice_sessions (user_id, start_time)",
+        "CREATE INDEX IF NOT EXISTS idx_applications_pending ON applications (status) WHERE status = 'pending'",
+        "CREATE INDEX IF NOT EXISTS idx_applications_submitted ON applications (submitted_at)",
+        "CREATE INDEX IF NOT EXISTS idx_casino_balance_balance ON casino_balance (balance)",
+    ],
+    # 3: постоянный кэш имён пользователей для лидерборда
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS user_names (
+            user_id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL
+        )
+        ''',
+    ],
+    # 4: общая таблица кулдаунов вместо work_timer
+    migrate_cooldowns,
+    # 5: дневные итоги голосовой активности
+    migrate_voice_daily_totals,
+    # 6: покрывающий индекс для топа войса за период
+    [
+        "CREATE INDEX IF NOT EXISTS idx_voice_daily_totals_day ON voice_daily_totals (day, user_id, seconds)",
+    ],
+    # 7: время в целых миллисекундах вместо ISO-строк
+    migrate_epoch_ms,
+    # 8: журнал изменений состава семьи для дельта-бэкапов
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS family_deltas (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            at INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            role_id INTEGER
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_family_deltas_guild_at ON family_deltas (guild_id, at)",
+    ],
+    # 9: каталог базовых снимков состава
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS backup_catalog (
+            guild_id INTEGER NOT NULL,
+            taken_at INTEGER NOT NULL,
+            path TEXT NOT NULL,
+            member_count INTEGER NOT NULL,
+            checksum TEXT NOT NULL,
+            PRIMARY KEY (guild_id, taken_at)
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 10: служебные отметки бота (последняя запись буфера голоса)
+    [
+        '''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+    ],
+    # 11: рейтинг казино считается в памяти, индекс по балансу только замедляет запись
+    [
+        "DROP INDEX IF EXISTS idx_casino_balance_balance",
+    ],
+    # 12: время получения имени в кэше user_names (старые записи считаются устаревшими)
+    [
+        "ALTER TABLE user_names ADD COLUMN fetched_at INTEGER NOT NULL DEFAULT 0",
+    ],
+]
 
-    conn.commit()
-    conn.close()
+# === ИНИЦИАЛИЗАЦИЯ БАЗЫ ДАННЫХ ===
+def init_db():
+    version = db.fetchone("PRAGMA user_version")[0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        with db.transaction() as cursor:
+            # DDL в sqlite3 не открывает транзакцию сам — открываем явно, чтобы миграция была атомарной
+            cursor.execute("BEGIN")
+            if callable(migration):
+                migration(cursor)
+            else:
+                for sql in migration:
+                    cursor.execute(sql)
+            cursor.execute(f"PRAGMA user_version = {number}")
+        print(f"🗄️ Применена миграция БД #{number}")
 
 init_db()
 
+# === КЭШ КОНФИГУРАЦИИ ===
+# Таблица config целиком держится в памяти: она читается почти в каждой команде,
+# а меняется только через /привязка. Запись идёт сквозь кэш (сначала БД, затем память).
+class ConfigCache:
+    def __init__(self):
+        self.values = {}
+        self.hits = 0
+        self.misses = 0
+
+    def load(self):
+        self.values = dict(db.fetchall("SELECT key, value FROM config"))
+
+    def get(self, key: str, default=None):
+        if key in self.values:
+            self.hits += 1
+            return self.values[key]
+        self.misses += 1
+        return default
+
+    def get_int(self, key: str, default: int = 0) -> int:
+        value = self.get(key)
+        try:
+            return int(value) if value is not None else default
+        except ValueError:
+            return default
+
+    def update(self, values: dict):
+        self.values.update(values)
+
+config_cache = ConfigCache()
+config_cache.load()
+
 # === ФУНКЦИИ КОНФИГУРАЦИИ ===
+@adb.register
 def set_config(key: str, value: str):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, value))
-    conn.commit()
-    conn.close()
+    set_configs({key: value})
+
+@adb.register
+def set_configs(values: dict):
+    db.executemany("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", list(values.items()))
+    config_cache.update(values)
 
 def get_config(key: str, default=None):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT value FROM config WHERE key = ?", (key,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else default
-
-def get_family_roles(guild: discord.Guild):
-    return {
-        "member": guild.get_role(int(get_config("family_role_id", 0))),
-        "leader": guild.get_role(int(get_config("leader_role_id", 0))),
-        "deputy_leader": guild.get_role(int(get_config("deputy_leader_role_id", 0))),
-        "high_staff": guild.get_role(int(get_config("high_staff_role_id", 0))),
-        "main_staff": guild.get_role(int(get_config("main_staff_role_id", 0))),
-        "recruit": guild.get_role(int(get_config("recruit_role_id", 0))),
-    }
+    return config_cache.get(key, default)
+
+FAMILY_ROLE_KEYS = {
+    "member": "family_role_id",
+    "leader": "leader_role_id",
+    "deputy_leader": "deputy_leader_role_id",
+    "high_staff": "high_staff_role_id",
+    "main_staff": "main_staff_role_id",
+    "recruit": "recruit_role_id",
+}
+
+# Ранги в порядке старшинства (общая роль участника сюда не входит)
+FAMILY_RANKS = [
+    ("leader", "[Лидер]"),
+    ("deputy_leader", "[Заместитель Лидера]"),
+    ("high_staff", "[ʜɪɢʜ sᴛᴀꜰꜰ]"),
+    ("main_staff", "[ᴍᴀɪɴ sᴛᴀꜰꜰ]"),
+    ("recruit", "[ʀᴇᴄʀᴜɪᴛ]"),
+]
+
+# === РОЛИ СЕМЬИ ===
+# Разрешённые роли семьи строятся один раз на сервер и сбрасываются только
+# при /привязка, удалении или изменении роли и переподключении к шлюзу.
+class FamilyRoles:
+    def __init__(self, guild: discord.Guild):
+        self.guild_id = guild.id
+        self.roles = {name: guild.get_role(config_cache.get_int(key)) for name, key in FAMILY_ROLE_KEYS.items()}
+        self.ids = frozenset(role.id for role in self.roles.values() if role)
+        self.rank_order = [(self.roles[name], title) for name, title in FAMILY_RANKS if self.roles[name]]
+
+    def __getitem__(self, name: str):
+        return self.roles[name]
+
+    def values(self):
+        return self.roles.values()
+
+    def family_roles_of(self, member) -> list:
+        return [role for role in member.roles if role.id in self.ids]
+
+    def is_family(self, member) -> bool:
+        return any(role.id in self.ids for role in member.roles)
+
+family_roles_cache = {}
+
+def get_family_roles(guild: discord.Guild) -> FamilyRoles:
+    roles = family_roles_cache.get(guild.id)
+    if roles is None:
+        roles = family_roles_cache[guild.id] = FamilyRoles(guild)
+    return roles
+
+def invalidate_family_roles(guild_id: int = None):
+    # Индекс состава зависит от набора ролей, поэтому сбрасывается вместе с ним
+    if guild_id is None:
+        family_roles_cache.clear()
+        family_indexes.clear()
+    else:
+        family_roles_cache.pop(guild_id, None)
+        family_indexes.pop(guild_id, None)
+    # Новый индекс может разойтись с журналом изменений — нужен свежий базовый снимок
+    family_journal.invalidate(guild_id)
+
+# === ИНДЕКС СОСТАВА СЕМЬИ ===
+# Кто из участников носит какие роли семьи. Строится один раз (после загрузки участников
+# в on_ready) и дальше поддерживается событиями on_member_update/join/remove,
+# так что списки и счётчики семьи стоят O(размер семьи), а не O(размер сервера).
+class FamilyIndex:
+    def __init__(self, guild: discord.Guild, roles: FamilyRoles):
+        self.guild = guild
+        self.roles = roles
+        self.by_role = {role_id: set() for role_id in roles.ids}
+        self.members = {}
+        for member in guild.members:
+            self.update(member)
+
+    def update(self, member):
+        # Возвращает (добавленные, снятые) id ролей семьи для этого участника
+        old = self.members.get(member.id, frozenset())
+        new = frozenset() if member.bot else frozenset(role.id for role in self.roles.family_roles_of(member))
+        if old == new:
+            return frozenset(), frozenset()
+        for role_id in old - new:
+            self.by_role[role_id].discard(member.id)
+        for role_id in new - old:
+            self.by_role[role_id].add(member.id)
+        if new:
+            self.members[member.id] = new
+        else:
+            self.members.pop(member.id, None)
+        return new - old, old - new
+
+    def remove(self, member_id: int):
+        old = self.members.pop(member_id, frozenset())
+        for role_id in old:
+            self.by_role[role_id].discard(member_id)
+        return old
+
+    def members_with(self, role: discord.Role) -> list:
+        ids = self.by_role.get(role.id, ())
+        return [m for m in map(self.guild.get_member, ids) if m]
+
+    def all_members(self) -> list:
+        return [m for m in map(self.guild.get_member, self.members) if m]
+
+family_indexes = {}
+
+def get_family_index(guild: discord.Guild) -> FamilyIndex:
+    index = family_indexes.get(guild.id)
+    if index is None:
+        index = family_indexes[guild.id] = FamilyIndex(guild, get_family_roles(guild))
+    return index
+
+def refresh_family_roles(guild: discord.Guild, role_id: int = None):
+    # Индекс пересобирается сразу, пока кэш участников совпадает с журналом:
+    # ленивая пересборка при следующем событии уже видела бы новое состояние и теряла изменение.
+    # С role_id сброс нужен, только если это роль семьи. Новый базовый снимок пишется сразу,
+    # чтобы изменения по новому набору ролей не накладывались на старую базу.
+    roles = family_roles_cache.get(guild.id)
+    if role_id is not None and (roles is None or role_id not in roles.ids):
+        return
+    invalidate_family_roles(guild.id)
+    get_family_index(guild)
+    schedule_base_backup(guild)
 
 def get_log_channel(guild: discord.Guild):
-    cid = get_config("log_channel_id")
-    return guild.get_channel(int(cid)) if cid else None
+    return guild.get_channel(config_cache.get_int("log_channel_id"))
 
 def get_notify_channel(guild: discord.Guild):
-    cid = get_config("notify_channel_id")
-    return guild.get_channel(int(cid)) if cid else None
+    return guild.get_channel(config_cache.get_int("notify_channel_id"))
 
 def get_threads_channel(guild: discord.Guild):
-    cid = get_config("threads_channel_id")
-    return guild.get_channel(int(cid)) if cid else None
+    return guild.get_channel(config_cache.get_int("threads_channel_id"))
 
 def has_any_role(member: discord.Member, roles: list) -> bool:
     if member.guild_permissions.administrator:
         return True
     return any(role in member.roles for role in roles if role)
 
+# === КЭШ СПИСКОВ: ЧС, ВАЙТ-ЛИСТ, БАН КАЗИНО ===
+# Таблицы маленькие и меняются редко, а проверяются на каждую заявку, кнопку казино
+# и выдачу роли. Держим id в памяти, хелперы записи обновляют множества после commit.
+class UserIdSet:
+    def __init__(self, table: str):
+        self.table = table
+        self.ids = set()
+
+    def load(self):
+        self.ids = {row[0] for row in db.fetchall(f"SELECT user_id FROM {self.table}")}
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self.ids
+
+family_blacklist = UserIdSet("family_blacklist")
+white_list = UserIdSet("white_list")
+casino_bans = UserIdSet("casino_ban")
+blacklist_reasons = {}  # заполняется лениво при первом запросе причины
+
+for cache in (family_blacklist, white_list, casino_bans):
+    cache.load()
+
+# === РЕЙТИНГ КАЗИНО В ПАМЯТИ ===
+# Упорядоченный индекс балансов для запросов «какое у меня место» без сортировки в SQLite.
+# Ключи (-баланс, -user_id) лежат в отсортированных корзинах по ~RANKING_LOAD штук,
+# а дерево Фенвика над размерами корзин даёт префиксные суммы за O(log n):
+# место и поиск по позиции — O(log n), вставка/удаление — O(log n + RANKING_LOAD).
+# Порядок совпадает с SQL лидерборда: balance DESC, user_id DESC.
+RANKING_LOAD = 512
+
+class FenwickTree:
+    def __init__(self, sizes: list):
+        self.tree = [0] * (len(sizes) + 1)
+        for i, size in enumerate(sizes):
+            self.add(i, size)
+
+    def add(self, i: int, delta: int):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i: int) -> int:
+        # Сумма элементов [0, i)
+        total = 0
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, k: int):
+        # Индекс элемента, содержащего k-ю (с нуля) позицию, и смещение внутри него
+        pos = 0
+        step = 1 << (len(self.tree).bit_length())
+        while step:
+            nxt = pos + step
+            if nxt < len(self.tree) and self.tree[nxt] <= k:
+                pos = nxt
+                k -= self.tree[nxt]
+            step >>= 1
+        return pos, k
+
+class BalanceRanking:
+    def __init__(self, load: int = RANKING_LOAD):
+        self.load_factor = load
+        self.lock = threading.Lock()
+        self.balances = {}
+        self.buckets = []
+        self.maxes = []
+        self.fenwick = FenwickTree([])
+
+    def __len__(self) -> int:
+        return len(self.balances)
+
+    def load(self, rows):
+        with self.lock:
+            self.balances = dict(rows)
+            keys = sorted((-balance, -user_id) for user_id, balance in self.balances.items())
+            self.buckets = [keys[i:i + self.load_factor] for i in range(0, len(keys), self.load_factor)]
+            self._reindex()
+
+    def _reindex(self):
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self.fenwick = FenwickTree([len(bucket) for bucket in self.buckets])
+
+    def _insert(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self._reindex()
+            return
+        b = bisect.bisect_left(self.maxes, key)
+        if b == len(self.buckets):
+            b -= 1
+        bucket = self.buckets[b]
+        bisect.insort(bucket, key)
+        self.maxes[b] = bucket[-1]
+        self.fenwick.add(b, 1)
+        if len(bucket) > self.load_factor * 2:
+            half = len(bucket) // 2
+            self.buckets[b:b + 1] = [bucket[:half], bucket[half:]]
+            self._reindex()
+
+    def _remove(self, key):
+        b = bisect.bisect_left(self.maxes, key)
+        bucket = self.buckets[b]
+        del bucket[bisect.bisect_left(bucket, key)]
+        if bucket:
+            self.maxes[b] = bucket[-1]
+            self.fenwick.add(b, -1)
+        else:
+            del self.buckets[b]
+            self._reindex()
+
+    def update(self, user_id: int, balance: int):
+        with self.lock:
+            old = self.balances.get(user_id)
+            if old == balance:
+                return
+            if old is not None:
+                self._remove((-old, -user_id))
+            self.balances[user_id] = balance
+            self._insert((-balance, -user_id))
+
+    def update_many(self, rows):
+        for user_id, balance in rows:
+            self.update(user_id, balance)
+
+    def rank(self, user_id: int):
+        # Место с единицы или None, если пользователь не играл
+        with self.lock:
+            balance = self.balances.get(user_id)
+            if balance is None:
+                return None
+            key = (-balance, -user_id)
+            b = bisect.bisect_left(self.maxes, key)
+            return self.fenwick.prefix(b) + bisect.bisect_left(self.buckets[b], key) + 1
+
+    def slice(self, start: int, stop: int) -> list:
+        # [(user_id, balance)] для мест start+1 .. stop
+        with self.lock:
+            stop = min(stop, len(self.balances))
+            if start >= stop:
+                return []
+            b, i = self.fenwick.find(start)
+            result = []
+            while len(result) < stop - start:
+                bucket = self.buckets[b]
+                for neg_balance, neg_user in bucket[i:i + stop - start - len(result)]:
+                    result.append((-neg_user, -neg_balance))
+                b, i = b + 1, 0
+            return result
+
+    def neighbours(self, user_id: int, radius: int = 2):
+        # (место пользователя, [(место, user_id, balance)] вокруг него)
+        place = self.rank(user_id)
+        if place is None:
+            return None, []
+        start = max(0, place - 1 - radius)
+        rows = self.slice(start, place + radius)
+        return place, [(start + i + 1, uid, balance) for i, (uid, balance) in enumerate(rows)]
+
+balance_ranking = BalanceRanking()
+balance_ranking.load(db.fetchall("SELECT user_id, balance FROM casino_balance"))
+
 # === ФУНКЦИИ ДЛЯ РАБОТЫ С БД ===
+@adb.register
 def get_balance(user_id: int) -> int:
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT balance FROM casino_balance WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
+    result = db.fetchone("SELECT balance FROM casino_balance WHERE user_id = ?", (user_id,))
     if result is None:
-        cursor.execute("INSERT INTO casino_balance (user_id, balance) VALUES (?, 10000)", (user_id,))
-        conn.commit()
+        db.execute("INSERT OR IGNORE INTO casino_balance (user_id, balance) VALUES (?, 10000)", (user_id,))
+        balance_ranking.update(user_id, 10000)
         result = (10000,)
-    conn.close()
     return result[0]
 
+@adb.register
 def set_balance(user_id: int, amount: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO casino_balance (user_id, balance) VALUES (?, ?)", (user_id, max(0, amount)))
-    conn.commit()
-    conn.close()
+    db.execute("INSERT OR REPLACE INTO casino_balance (user_id, balance) VALUES (?, ?)", (user_id, max(0, amount)))
+    balance_ranking.update(user_id, max(0, amount))
+
+@adb.register
+def settle_bet(user_id: int, stake: int, payout: int):
+    # Списание ставки и выплата одной транзакцией относительными UPDATE.
+    # Возвращает новый баланс или None, если на счету меньше ставки.
+    with db.transaction() as cursor:
+        cursor.execute("INSERT OR IGNORE INTO casino_balance (user_id, balance) VALUES (?, 10000)", (user_id,))
+        cursor.execute(
+            "UPDATE casino_balance SET balance = balance - ? + ? WHERE user_id = ? AND balance >= ?",
+            (stake, payout, user_id, stake)
+        )
+        settled = cursor.rowcount > 0
+        # Баланс читается и при отказе: строка могла только что появиться через INSERT OR IGNORE
+        cursor.execute("SELECT balance FROM casino_balance WHERE user_id = ?", (user_id,))
+        balance = cursor.fetchone()[0]
+    balance_ranking.update(user_id, balance)
+    return balance if settled else None
+
+@adb.register
+def get_user_names(user_ids: list) -> dict:
+    # user_id -> (имя, когда получено)
+    placeholders = ", ".join("?" * len(user_ids))
+    rows = db.fetchall(f"SELECT user_id, name, fetched_at FROM user_names WHERE user_id IN ({placeholders})", tuple(user_ids))
+    return {user_id: (name, fetched_at) for user_id, name, fetched_at in rows}
+
+@adb.register
+def save_user_names(names: dict, fetched_at: int):
+    db.executemany(
+        "INSERT OR REPLACE INTO user_names (user_id, name, fetched_at) VALUES (?, ?, ?)",
+        [(user_id, name, fetched_at) for user_id, name in names.items()]
+    )
+
+# Массовые операции: id загружаются во временную таблицу одним executemany,
+# затем баланс меняется одним UPSERT на всё множество.
+def _load_bulk_ids(cursor, user_ids):
+    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS bulk_ids (user_id INTEGER PRIMARY KEY)")
+    cursor.execute("DELETE FROM bulk_ids")
+    cursor.executemany("INSERT OR IGNORE INTO bulk_ids (user_id) VALUES (?)", ((uid,) for uid in user_ids))
+
+@adb.register
+def reset_balances(user_ids, value: int = 10000):
+    # Возвращает (число счетов, сумма на них до сброса)
+    with db.transaction() as cursor:
+        _load_bulk_ids(cursor, user_ids)
+        cursor.execute(
+            "SELECT COUNT(*), COALESCE(SUM(c.balance), 0) FROM bulk_ids b "
+            "LEFT JOIN casino_balance c ON c.user_id = b.user_id"
+        )
+        affected, previous_total = cursor.fetchone()
+        cursor.execute(
+            "INSERT INTO casino_balance (user_id, balance) SELECT user_id, ? FROM bulk_ids WHERE true "
+            "ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance",
+            (value,)
+        )
+        cursor.execute("SELECT user_id FROM bulk_ids")
+        user_ids = [row[0] for row in cursor.fetchall()]
+        cursor.execute("DELETE FROM bulk_ids")
+    balance_ranking.update_many((user_id, value) for user_id in user_ids)
+    return affected, previous_total
+
+@adb.register
+def credit_balances(user_ids, amount: int):
+    # Возвращает (число счетов, общая выданная сумма)
+    with db.transaction() as cursor:
+        _load_bulk_ids(cursor, user_ids)
+        cursor.execute(
+            "INSERT INTO casino_balance (user_id, balance) SELECT user_id, 10000 + ? FROM bulk_ids WHERE true "
+            "ON CONFLICT(user_id) DO UPDATE SET balance = balance + ?",
+            (amount, amount)
+        )
+        affected = cursor.rowcount
+        cursor.execute("SELECT c.user_id, c.balance FROM bulk_ids b JOIN casino_balance c ON c.user_id = b.user_id")
+        rows = cursor.fetchall()
+        cursor.execute("DELETE FROM bulk_ids")
+    balance_ranking.update_many(rows)
+    return affected, affected * amount
 
 def is_casino_banned(user_id: int) -> bool:
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM casino_ban WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+    return user_id in casino_bans
 
+@adb.register
 def ban_from_casino(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO casino_ban (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
+    db.execute("INSERT OR REPLACE INTO casino_ban (user_id) VALUES (?)", (user_id,))
+    casino_bans.ids.add(user_id)
 
+@adb.register
 def unban_from_casino(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM casino_ban WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    db.execute("DELETE FROM casino_ban WHERE user_id = ?", (user_id,))
+    casino_bans.ids.discard(user_id)
 
 def get_all_family_members(guild: discord.Guild) -> list:
-    roles = get_family_roles(guild)
-    valid_ids = {r.id for r in roles.values() if r}
-    members = []
-    for member in guild.members:
-        if member.bot:
-            continue
-        if any(role.id in valid_ids for role in member.roles):
-            members.append(member)
-    return members
-
-def can_work(user_id: int) -> bool:
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_work FROM work_timer WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    if not result:
-        return True
-    last_work = datetime.fromisoformat(result[0].replace("Z", "+00:00"))
-    return datetime.now(timezone.utc) - last_work > timedelta(minutes=5)
-
-def update_work_time(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    now = datetime.now(timezone.utc).isoformat()
-    cursor.execute("INSERT OR REPLACE INTO work_timer (user_id, last_work) VALUES (?, ?)", (user_id, now))
-    conn.commit()
-    conn.close()
-
-def add_voice_session(user_id: int, channel_id: int, start_time: datetime):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO voice_sessions (user_id, channel_id, start_time, end_time) VALUES (?, ?, ?, ?)",
-        (user_id, channel_id, start_time.isoformat(), None)
+    return get_family_index(guild).all_members()
+
+# user_id -> id открытой строки voice_sessions. Меняется только в потоке БД,
+# поэтому закрытие сессии — обновление по первичному ключу, без поиска end_time IS NULL.
+voice_open_rows = {}
+
+@adb.register
+def load_open_voice_sessions() -> list:
+    # Дубли открытых сессий одного пользователя (остались от старых падений) закрываются нулевой длиной
+    with db.transaction() as cursor:
+        cursor.execute('''
+            UPDATE voice_sessions SET end_time = start_time
+            WHERE end_time IS NULL AND id NOT IN (
+                SELECT MAX(id) FROM voice_sessions WHERE end_time IS NULL GROUP BY user_id
+            )
+        ''')
+        rows = cursor.execute("SELECT id, user_id, channel_id, start_time FROM voice_sessions WHERE end_time IS NULL").fetchall()
+    voice_open_rows.clear()
+    voice_open_rows.update((user_id, row_id) for row_id, user_id, _, _ in rows)
+    return [(user_id, channel_id, start_time) for _, user_id, channel_id, start_time in rows]
+
+@adb.register
+def get_voice_alive_at():
+    # Когда буфер голоса последний раз успешно писался — бот был жив как минимум до этого момента
+    row = db.fetchone("SELECT value FROM bot_state WHERE key = 'voice_alive_at'")
+    return row[0] if row else None
+
+@adb.register
+def write_voice_events(events: list, alive_at: int = None):
+    # События применяются по порядку в одной транзакции: один fsync на пачку.
+    # Карта открытых строк обновляется только после успешного коммита.
+    open_rows = dict(voice_open_rows)
+    with db.transaction() as cursor:
+        if alive_at is not None:
+            cursor.execute(
+                "INSERT INTO bot_state (key, value) VALUES ('voice_alive_at', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (alive_at,)
+            )
+        for kind, user_id, channel_id, start, at in events:
+            if kind == "start":
+                cursor.execute(
+                    "INSERT INTO voice_sessions (user_id, channel_id, start_time, end_time) VALUES (?, ?, ?, ?)",
+                    (user_id, channel_id, at, None)
+                )
+                open_rows[user_id] = cursor.lastrowid
+            else:
+                row_id = open_rows.pop(user_id, None)
+                if row_id is not None:
+                    cursor.execute("UPDATE voice_sessions SET end_time = ? WHERE id = ?", (at, row_id))
+                    cursor.executemany(
+                        '''
+                        INSERT INTO voice_daily_totals (user_id, day, channel_id, seconds) VALUES (?, ?, ?, ?)
+                        ON CONFLICT (user_id, day, channel_id) DO UPDATE SET seconds = seconds + excluded.seconds
+                        ''',
+                        [(user_id, day, channel_id, round(seconds)) for day, seconds in split_by_day(start, at)]
+                    )
+    voice_open_rows.clear()
+    voice_open_rows.update(open_rows)
+
+@adb.register
+def get_voice_totals(user_id: int, days: tuple) -> list:
+    # Итоги за последние N дней (включая сегодняшний) и за всё время одним проходом по ключу пользователя
+    today = now_ms() // DAY_MS
+    since = [today - (n - 1) for n in days]
+    columns = ", ".join("COALESCE(SUM(CASE WHEN day >= ? THEN seconds END), 0)" for _ in since)
+    row = db.fetchone(
+        f"SELECT {columns}, COALESCE(SUM(seconds), 0) FROM voice_daily_totals WHERE user_id = ?",
+        (*since, user_id)
     )
-    conn.commit()
-    conn.close()
-
-def end_voice_session(user_id: int, end_time: datetime):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE voice_sessions SET end_time = ? WHERE user_id = ? AND end_time IS NULL",
-        (end_time.isoformat(), user_id)
+    return list(row)
+
+@adb.register
+def get_voice_totals_since(since: int) -> list:
+    # Сумма по каждому пользователю с дня since; читается только покрывающий индекс по day.
+    # Без статистики планировщик выбирает полный обход по первичному ключу ради GROUP BY, поэтому индекс указан явно
+    return db.fetchall(
+        "SELECT user_id, SUM(seconds) FROM voice_daily_totals INDEXED BY idx_voice_daily_totals_day WHERE day >= ? GROUP BY user_id",
+        (since,)
     )
-    conn.commit()
-    conn.close()
 
+@adb.register
 def get_user_sessions(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute(
+    return db.fetchall(
         "SELECT channel_id, start_time, end_time FROM voice_sessions WHERE user_id = ? ORDER BY start_time DESC LIMIT 20",
         (user_id,)
     )
-    rows = cursor.fetchall()
-    conn.close()
-    return rows
 
+@adb.register
+def get_voice_overview(user_id: int, days: tuple):
+    # Оба чтения одним заданием: между снимком незаписанных событий и чтением не должно вклиниться сохранение
+    return get_user_sessions(user_id), get_voice_totals(user_id, days)
+
+@adb.register
 def add_to_family_blacklist(user_id: int, reason: str, added_by: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    now = datetime.now(timezone.utc).isoformat()
-    cursor.execute(
+    db.execute(
         "INSERT OR REPLACE INTO family_blacklist (user_id, reason, added_by, added_at) VALUES (?, ?, ?, ?)",
-        (user_id, reason, added_by, now)
+        (user_id, reason, added_by, now_ms())
     )
-    conn.commit()
-    conn.close()
+    family_blacklist.ids.add(user_id)
+    blacklist_reasons[user_id] = reason
 
+@adb.register
 def remove_from_family_blacklist(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM family_blacklist WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    db.execute("DELETE FROM family_blacklist WHERE user_id = ?", (user_id,))
+    family_blacklist.ids.discard(user_id)
+    blacklist_reasons.pop(user_id, None)
 
 def is_in_family_blacklist(user_id: int) -> bool:
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM family_blacklist WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
-
-def get_blacklist_reason(user_id: int) -> str:
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT reason FROM family_blacklist WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else "Не указана"
+    return user_id in family_blacklist
+
+@adb.register
+def fetch_blacklist_reason(user_id: int):
+    result = db.fetchone("SELECT reason FROM family_blacklist WHERE user_id = ?", (user_id,))
+    return result[0] if result else None
+
+async def get_blacklist_reason(user_id: int) -> str:
+    if user_id not in blacklist_reasons:
+        reason = await adb.fetch_blacklist_reason(user_id)
+        if reason is None:
+            return "Не указана"
+        blacklist_reasons[user_id] = reason
+    return blacklist_reasons[user_id]
 
 # === УБРАНО ОГРАНИЧЕНИЕ НА ЗАЯВКИ ===
 def can_submit_application(user_id: int) -> bool:
     return True
 
+@adb.register
 def record_application(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    now = datetime.now(timezone.utc).isoformat()
-    cursor.execute("INSERT INTO applications (user_id, submitted_at) VALUES (?, ?)", (user_id, now))
-    conn.commit()
-    conn.close()
+    db.execute("INSERT INTO applications (user_id, submitted_at) VALUES (?, ?)", (user_id, now_ms()))
 
+@adb.register
 def get_pending_applications_count() -> int:
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM applications WHERE status = 'pending'")
-    count = cursor.fetchone()[0]
-    conn.close()
-    return count
+    return db.fetchone("SELECT COUNT(*) FROM applications WHERE status = 'pending'")[0]
 
+@adb.register
 def get_last_application_time() -> str:
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT submitted_at FROM applications ORDER BY submitted_at DESC LIMIT 1")
-    result = cursor.fetchone()
-    conn.close()
+    result = db.fetchone("SELECT submitted_at FROM applications ORDER BY submitted_at DESC LIMIT 1")
     if not result:
         return "Никогда"
-    dt = datetime.fromisoformat(result[0].replace("Z", "+00:00"))
-    now = datetime.now(timezone.utc)
-    diff = now - dt
-    hours = int(diff.total_seconds() // 3600)
+    hours = (now_ms() - result[0]) // 3_600_000
     if hours < 1:
         return "менее часа назад"
     elif hours == 1:
@@ -332,23 +1060,16 @@ def get_last_application_time() -> str:
     else:
         return f"{hours} часов назад"
 
+@adb.register
 def save_profile(user_id: int, nickname: str, static_id: str):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute(
+    db.execute(
         "INSERT OR REPLACE INTO profiles (user_id, nickname, static_id) VALUES (?, ?, ?)",
         (user_id, nickname, static_id)
     )
-    conn.commit()
-    conn.close()
 
+@adb.register
 def get_profile(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT nickname, static_id FROM profiles WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result
+    return db.fetchone("SELECT nickname, static_id FROM profiles WHERE user_id = ?", (user_id,))
 
 async def log_action(guild, action: str, details: str, color=0x2b2d31):
     log_channel = get_log_channel(guild)
@@ -361,100 +1082,576 @@ async def log_action(guild, action: str, details: str, color=0x2b2d31):
         )
         await log_channel.send(embed=embed)
 
-def backup_guild(guild: discord.Guild):
-    roles = get_family_roles(guild)
-    valid_ids = {r.id for r in roles.values() if r}
-    data = {
-        "timestamp": datetime.now(timezone.utc).isoformat(),
-        "guild_id": guild.id,
-        "guild_name": guild.name,
-        "members": []
-    }
-    for member in guild.members:
-        if member.bot:
+# === ДЕЛЬТА-БЭКАПЫ СОСТАВА ===
+# Полный базовый снимок пишется при запуске, после смены ролей семьи и раз в BACKUP_BASE_INTERVAL.
+# Между снимками события участников пишутся в family_deltas: add/remove роли, join/leave.
+# Состав на любой момент = последний снимок не позже него + изменения после снимка.
+# Повторное применение изменений к снимку безопасно: каждое задаёт наличие роли, а не переключает его.
+BACKUP_BASE_INTERVAL = 24 * 3600 * 1000
+BACKUP_RETENTION_DAYS = 30
+BACKUP_NAME = re.compile(r"backup_(?:(\d+)_)?(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}(?:-\d{2})?)\.(?:json|jsonl\.gz)$")
+
+@adb.register
+def record_family_deltas(rows: list):
+    db.executemany("INSERT INTO family_deltas (guild_id, at, user_id, kind, role_id) VALUES (?, ?, ?, ?, ?)", rows)
+
+@adb.register
+def get_family_deltas(guild_id: int, after: int, until: int) -> list:
+    return db.fetchall(
+        "SELECT user_id, kind, role_id FROM family_deltas WHERE guild_id = ? AND at > ? AND at <= ? ORDER BY at, id",
+        (guild_id, after, until)
+    )
+
+@adb.register
+def prune_family_deltas(guild_id: int, before: int):
+    db.execute("DELETE FROM family_deltas WHERE guild_id = ? AND at <= ?", (guild_id, before))
+
+class FamilyJournal:
+    def __init__(self):
+        self.last = 0
+        self.bases = {}  # guild_id -> время последнего базового снимка в этом запуске
+
+    def stamp(self) -> int:
+        # Строго возрастающие отметки: изменение и снимок в одну миллисекунду не перепутаются
+        self.last = max(now_ms(), self.last + 1)
+        return self.last
+
+    def invalidate(self, guild_id: int = None):
+        if guild_id is None:
+            self.bases.clear()
+        else:
+            self.bases.pop(guild_id, None)
+
+    def base_due(self, guild_id: int) -> bool:
+        return now_ms() - self.bases.get(guild_id, 0) >= BACKUP_BASE_INTERVAL
+
+    async def record(self, guild_id: int, user_id: int, added=(), removed=(), event: str = None):
+        at = self.stamp()
+        rows = [(guild_id, at, user_id, event, None)] if event else []
+        rows += [(guild_id, at, user_id, "add", role_id) for role_id in added]
+        rows += [(guild_id, at, user_id, "remove", role_id) for role_id in removed]
+        if rows:
+            await adb.record_family_deltas(rows)
+
+family_journal = FamilyJournal()
+
+def parse_backup_time(text: str, end: bool = False):
+    # "YYYY-MM-DD_HH-MM" или "YYYY-MM-DD_HH-MM-SS" в UTC -> мс.
+    # С end=True — последняя миллисекунда указанной секунды/минуты: снимки помечены
+    # с точностью до мс, и иначе выбранный в подсказке снимок оказался бы "позже" запроса
+    for fmt, span in (("%Y-%m-%d_%H-%M-%S", 1000), ("%Y-%m-%d_%H-%M", 60_000)):
+        try:
+            at = to_ms(datetime.strptime(text, fmt).replace(tzinfo=timezone.utc))
+        except ValueError:
             continue
-        roles = [role.id for role in member.roles if role.id in valid_ids]
-        if roles:
-            data["members"].append({
-                "user_id": member.id,
-                "name": member.name,
-                "display_name": member.display_name,
-                "roles": roles,
-                "joined_at": member.joined_at.isoformat() if member.joined_at else None
-            })
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M")
-    filename = f"backups/backup_{timestamp}.json"
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-
-    cutoff = datetime.now() - timedelta(days=30)
-    for file in os.listdir("backups"):
+        return at + span - 1 if end else at
+    return None
+
+# --- каталог снимков ---
+# Снимки ищутся по индексу (guild_id, taken_at) в backup_catalog, а не перебором папки.
+# Каталог сверяется с папкой backups один раз при запуске.
+@adb.register
+def add_backup_entry(guild_id: int, taken_at: int, path: str, member_count: int, checksum: str):
+    db.execute(
+        "INSERT OR REPLACE INTO backup_catalog (guild_id, taken_at, path, member_count, checksum) VALUES (?, ?, ?, ?, ?)",
+        (guild_id, taken_at, path, member_count, checksum)
+    )
+
+@adb.register
+def find_backup_before(guild_id: int, at: int):
+    return db.fetchone(
+        "SELECT taken_at, path, checksum FROM backup_catalog WHERE guild_id = ? AND taken_at <= ? "
+        "ORDER BY taken_at DESC LIMIT 1",
+        (guild_id, at)
+    )
+
+@adb.register
+def find_backups_near(guild_id: int, at, limit: int) -> list:
+    # Ближайшие по времени снимки: по limit с каждой стороны от at, затем по расстоянию
+    if at is None:
+        return db.fetchall(
+            "SELECT taken_at, member_count FROM backup_catalog WHERE guild_id = ? ORDER BY taken_at DESC LIMIT ?",
+            (guild_id, limit)
+        )
+    before = db.fetchall(
+        "SELECT taken_at, member_count FROM backup_catalog WHERE guild_id = ? AND taken_at <= ? "
+        "ORDER BY taken_at DESC LIMIT ?",
+        (guild_id, at, limit)
+    )
+    after = db.fetchall(
+        "SELECT taken_at, member_count FROM backup_catalog WHERE guild_id = ? AND taken_at > ? "
+        "ORDER BY taken_at LIMIT ?",
+        (guild_id, at, limit)
+    )
+    return sorted(before + after, key=lambda row: abs(row[0] - at))[:limit]
+
+@adb.register
+def prune_backup_catalog(guild_id: int, cutoff: int):
+    # -> (пути удалённых из каталога снимков, время самого раннего оставшегося)
+    with db.transaction() as cursor:
+        paths = [row[0] for row in cursor.execute(
+            "SELECT path FROM backup_catalog WHERE guild_id = ? AND taken_at < ?", (guild_id, cutoff)
+        )]
+        cursor.execute("DELETE FROM backup_catalog WHERE guild_id = ? AND taken_at < ?", (guild_id, cutoff))
+        oldest = cursor.execute(
+            "SELECT MIN(taken_at) FROM backup_catalog WHERE guild_id = ?", (guild_id,)
+        ).fetchone()[0]
+    return paths, oldest
+
+def file_checksum(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def write_snapshot(path: str, header: dict, members: list):
+    # Выполняется в рабочем потоке: участники пишутся по одному в gzip'нутый JSON-lines
+    # (первая строка — заголовок). Файл появляется под своим именем только целиком.
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", encoding="utf-8", compresslevel=6) as f:
+        f.write(json.dumps(header, ensure_ascii=False) + "\n")
+        for user_id, name, display_name, roles, joined_at in members:
+            record = {"user_id": user_id, "name": name, "display_name": display_name, "roles": roles, "joined_at": joined_at}
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(tmp, path)
+    return file_checksum(path)
+
+def read_snapshot(path: str) -> dict:
+    # {user_id: set(role_id)} из нового .jsonl.gz или старого .json
+    if path.endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            return {m["user_id"]: set(m["roles"]) for m in json.load(f)["members"]}
+    state = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        next(f)  # заголовок
+        for line in f:
+            member = json.loads(line)
+            state[member["user_id"]] = set(member["roles"])
+    return state
+
+def remove_files(paths: list):
+    for path in paths:
         try:
-            file_time = datetime.strptime(file.replace("backup_", "").replace(".json", ""), "%Y-%m-%d_%H-%M")
-            if file_time < cutoff:
-                os.remove(f"backups/{file}")
-        except:
+            os.remove(path)
+        except FileNotFoundError:
             pass
 
+def sync_backup_catalog():
+    # Добавляет в каталог файлы, которых в нём нет (снимки до появления каталога),
+    # и убирает записи о пропавших файлах. Записи с guild_id = 0 (старые файлы, занесённые
+    # без id сервера) пересобираются заново.
+    known = {path for (path,) in db.fetchall("SELECT path FROM backup_catalog WHERE guild_id != 0")}
+    on_disk = set()
+    rows = []
+    for file in os.listdir("backups"):
+        match = BACKUP_NAME.match(file)
+        if not match:
+            continue
+        path = f"backups/{file}"
+        on_disk.add(path)
+        if path in known:
+            continue
+        try:
+            if match[1]:
+                guild_id, taken_at = int(match[1]), parse_backup_time(match[2])
+                member_count = len(read_snapshot(path))
+            else:
+                # В имени старых файлов нет id сервера, а время локальное — берём их из содержимого
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                guild_id, taken_at = int(data["guild_id"]), iso_to_ms(data["timestamp"])
+                member_count = len(data["members"])
+        except (OSError, ValueError, KeyError, TypeError, EOFError, StopIteration) as e:
+            print(f"⚠️ Снимок {file} пропущен: {e}")
+            continue
+        rows.append((guild_id, taken_at, path, member_count, file_checksum(path)))
+    with db.transaction() as cursor:
+        cursor.execute("DELETE FROM backup_catalog WHERE guild_id = 0")
+        cursor.executemany(
+            "INSERT OR REPLACE INTO backup_catalog (guild_id, taken_at, path, member_count, checksum) VALUES (?, ?, ?, ?, ?)",
+            rows
+        )
+        cursor.executemany("DELETE FROM backup_catalog WHERE path = ?", ((path,) for path in known - on_disk))
+
+async def backup_guild(guild: discord.Guild) -> int:
+    # На цикле только снимаются значения из индекса; сериализация, сжатие и диск — в рабочем потоке
+    index = get_family_index(guild)
+    taken_at = family_journal.stamp()
+    header = {"timestamp": from_ms(taken_at).isoformat(), "taken_at": taken_at, "guild_id": guild.id, "guild_name": guild.name}
+    members = [
+        (member.id, member.name, member.display_name, sorted(index.members[member.id]),
+         member.joined_at.isoformat() if member.joined_at else None)
+        for member in index.all_members()
+    ]
+    timestamp = from_ms(taken_at).strftime("%Y-%m-%d_%H-%M-%S")
+    path = f"backups/backup_{guild.id}_{timestamp}.jsonl.gz"
+    checksum = await asyncio.to_thread(write_snapshot, path, header, members)
+    await adb.add_backup_entry(guild.id, taken_at, path, len(members), checksum)
+    family_journal.bases[guild.id] = taken_at
+
+    # Старые снимки удаляются, но изменения хранятся только начиная с самого раннего оставшегося
+    paths, oldest = await adb.prune_backup_catalog(guild.id, now_ms() - BACKUP_RETENTION_DAYS * DAY_MS)
+    await asyncio.to_thread(remove_files, paths)
+    return oldest
+
+async def family_state_at(guild_id: int, at: int):
+    # -> (состав {user_id: set(role_id)}, путь снимка, число изменений) или None, если снимка нет
+    snapshot = await adb.find_backup_before(guild_id, at)
+    if snapshot is None:
+        return None
+    base_at, path, checksum = snapshot
+    if await asyncio.to_thread(file_checksum, path) != checksum:
+        raise ValueError(f"контрольная сумма {os.path.basename(path)} не совпадает")
+    state = await asyncio.to_thread(read_snapshot, path)
+    deltas = await adb.get_family_deltas(guild_id, base_at, at)
+    for user_id, kind, role_id in deltas:
+        if kind == "add":
+            state.setdefault(user_id, set()).add(role_id)
+        elif kind == "remove" and user_id in state:
+            state[user_id].discard(role_id)
+            if not state[user_id]:
+                del state[user_id]
+        elif kind == "leave":
+            state.pop(user_id, None)
+    return state, path, len(deltas)
+
+sync_backup_catalog()
+
 async def change_status():
     while True:
-        pending = get_pending_applications_count()
+        pending = await adb.get_pending_applications_count()
         activity = discord.Game(f"Заявок: {pending}")
         await bot.change_presence(activity=activity)
         await asyncio.sleep(60)
 
+async def write_base_backup(guild: discord.Guild):
+    oldest = await backup_guild(guild)
+    await adb.prune_family_deltas(guild.id, oldest)
+
+async def scheduled_base_backup(guild: discord.Guild):
+    try:
+        await write_base_backup(guild)
+    except Exception as e:
+        print(f"Ошибка базового снимка {guild.name}: {e}")
+
+def schedule_base_backup(guild: discord.Guild):
+    # Индекс снимается синхронно в начале backup_guild, поэтому база соответствует
+    # составу на момент вызова, даже если задача дойдёт до диска позже
+    asyncio.create_task(scheduled_base_backup(guild))
+
 async def backup_task():
+    # Первую базу после запуска или переподключения пишет on_ready
     await bot.wait_until_ready()
     while not bot.is_closed():
-        for guild in bot.guilds:
-            backup_guild(guild)
         await asyncio.sleep(3600)
+        for guild in bot.guilds:
+            # В остальные часы состав уже сохранён в журнале изменений
+            if family_journal.base_due(guild.id):
+                await write_base_backup(guild)
 
 # === ФУНКЦИИ БЕЗОПАСНОСТИ ===
 def is_in_white_list(user_id: int) -> bool:
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM white_list WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
+    return user_id in white_list
 
+@adb.register
 def add_to_white_list(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR REPLACE INTO white_list (user_id) VALUES (?)", (user_id,))
-    conn.commit()
-    conn.close()
+    db.execute("INSERT OR REPLACE INTO white_list (user_id) VALUES (?)", (user_id,))
+    white_list.ids.add(user_id)
 
+@adb.register
 def get_strikes(user_id: int) -> int:
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT strikes FROM security_violations WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
+    result = db.fetchone("SELECT strikes FROM security_violations WHERE user_id = ?", (user_id,))
     return result[0] if result else 0
 
+@adb.register
 def add_strike(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    current = get_strikes(user_id)
-    cursor.execute("INSERT OR REPLACE INTO security_violations (user_id, strikes) VALUES (?, ?)", (user_id, current + 1))
-    conn.commit()
-    conn.close()
-    return current + 1
+    with db.transaction() as cursor:
+        cursor.execute(
+            "INSERT INTO security_violations (user_id, strikes) VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET strikes = strikes + 1",
+            (user_id,)
+        )
+        cursor.execute("SELECT strikes FROM security_violations WHERE user_id = ?", (user_id,))
+        return cursor.fetchone()[0]
 
+@adb.register
 def reset_strikes(user_id: int):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM security_violations WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+    db.execute("DELETE FROM security_violations WHERE user_id = ?", (user_id,))
+
+async def stop_flush_loop(writer):
+    # Останавливает фоновый цикл записи и дожидается начатой им записи: при ошибке
+    # она сама вернёт пачку в буфер, и финальный flush() запишет всё по порядку
+    if writer.task:
+        writer.task.cancel()
+        try:
+            await writer.task
+        except asyncio.CancelledError:
+            pass
+        writer.task = None
+    if writer.flushing:
+        await asyncio.gather(writer.flushing, return_exceptions=True)
+        writer.flushing = None
+
+# === БУФЕР ГОЛОСОВЫХ СЕССИЙ ===
+# Входы/выходы копятся в памяти и пишутся одной транзакцией раз в VOICE_FLUSH_INTERVAL
+# секунд или сразу при VOICE_FLUSH_MAX_EVENTS событиях. При остановке бота буфер сбрасывается.
+# Не реже раза в VOICE_HEARTBEAT_INTERVAL секунд вместе с пачкой пишется отметка "бот жив":
+# сессии, оставшиеся открытыми после падения, закрываются ею, а не временем запуска.
+VOICE_FLUSH_INTERVAL = 0.5
+VOICE_FLUSH_MAX_EVENTS = 50
+VOICE_HEARTBEAT_INTERVAL = 60
+
+class VoiceSessionWriter:
+    def __init__(self, interval: float, max_events: int):
+        self.interval = interval
+        self.max_events = max_events
+        self.buffer = []
+        self.open = {}  # user_id -> (channel_id, start) с учётом ещё не записанных событий
+        self.task = None
+        self.flushing = None
+        self.wakeup = asyncio.Event()
+        self.alive_at = None  # отметка прошлого запуска; нужна только первой сверке
+        self.reconciled = False
+        self.beat_at = 0
+
+    def load(self):
+        self.open = {user_id: (channel_id, start) for user_id, channel_id, start in load_open_voice_sessions()}
+        self.alive_at = get_voice_alive_at()
+
+    def start_session(self, user_id: int, channel_id: int, at: int):
+        if user_id in self.open:
+            # Пропущенный выход (например, во время переподключения) закрываем перед новой сессией
+            self.end_session(user_id, at)
+        self.open[user_id] = (channel_id, at)
+        self._push(("start", user_id, channel_id, at, at))
+
+    def end_session(self, user_id: int, at: int):
+        # Событие закрытия несёт канал и начало сессии — по ним поток БД обновляет дневные итоги
+        session = self.open.pop(user_id, None)
+        if session is None:
+            return
+        channel_id, start = session
+        self._push(("end", user_id, channel_id, start, at))
+
+    def reconcile(self, occupants: dict, at: int):
+        # occupants: user_id -> channel_id по текущим голосовым состояниям всех серверов.
+        # Сессии тех, кого уже нет в этом канале, закрываются; пришедшие без события — открываются.
+        # После перезапуска все сессии прошлого запуска закрываются последней отметкой "бот жив",
+        # а оставшиеся в голосе получают новую с текущего момента: простой бота не засчитывается.
+        for user_id, (channel_id, start) in list(self.open.items()):
+            if self.alive_at is not None:
+                self.end_session(user_id, max(start, min(at, self.alive_at)))
+            elif occupants.get(user_id) != channel_id:
+                self.end_session(user_id, at)
+        for user_id, channel_id in occupants.items():
+            if user_id not in self.open:
+                self.start_session(user_id, channel_id, at)
+        self.alive_at = None
+        self.reconciled = True
+
+    def _push(self, event):
+        self.buffer.append(event)
+        if len(self.buffer) >= self.max_events:
+            self.wakeup.set()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            # Отмена цикла не должна обрывать запись: пачка уже вынута из буфера,
+            # а задача в потоке БД может уже выполняться. close() дождётся её сам.
+            self.flushing = asyncio.ensure_future(self.flush())
+            try:
+                await asyncio.shield(self.flushing)
+            except Exception as e:
+                print(f"Ошибка записи голосовых сессий: {e}")
+
+    async def flush(self, heartbeat: bool = False):
+        # Отметку пишем только после первой сверки, иначе она затрёт время прошлого запуска
+        now = now_ms()
+        beat = self.reconciled and (heartbeat or now - self.beat_at >= VOICE_HEARTBEAT_INTERVAL * 1000)
+        if not self.buffer and not beat:
+            return
+        # Обмен буфера и отправка в поток БД происходят без переключения корутин,
+        # поэтому всё, что не попало в pending_for(), уже стоит в очереди записи раньше чтения.
+        batch, self.buffer = self.buffer, []
+        try:
+            await adb.write_voice_events(batch, now if beat else None)
+        except Exception:
+            self.buffer[:0] = batch
+            raise
+        if beat:
+            self.beat_at = now
+
+    async def close(self):
+        await stop_flush_loop(self)
+        await self.flush(heartbeat=True)
+
+    def pending_for(self, user_id: int) -> list:
+        return [event for event in self.buffer if event[1] == user_id]
+
+    def unrolled_intervals(self, now: int, user_id: int = None) -> list:
+        # Интервалы (user_id, начало, конец), ещё не попавшие в voice_daily_totals:
+        # незаписанные закрытия и открытые сессии
+        intervals = [
+            (uid, start, at) for kind, uid, _, start, at in self.buffer
+            if kind == "end" and (user_id is None or uid == user_id)
+        ]
+        if user_id is None:
+            intervals.extend((uid, start, now) for uid, (_, start) in self.open.items())
+        elif user_id in self.open:
+            intervals.append((user_id, self.open[user_id][1], now))
+        return intervals
+
+    def unrolled_days(self, user_id: int, now: int) -> dict:
+        days = {}
+        for _, start, end in self.unrolled_intervals(now, user_id):
+            for day, seconds in split_by_day(start, end):
+                days[day] = days.get(day, 0) + seconds
+        return days
+
+    @staticmethod
+    def apply_pending(rows, pending: list, limit: int = 20):
+        # Досчитывает ещё не записанные события поверх строк из БД (channel_id, start, end)
+        rows = [list(row) for row in rows]
+        for kind, _, channel_id, _, at in pending:
+            if kind == "start":
+                rows.append([channel_id, at, None])
+            else:
+                for row in rows:
+                    if row[2] is None:
+                        row[2] = at
+        rows.sort(key=lambda row: row[1], reverse=True)
+        return [tuple(row) for row in rows[:limit]]
+
+voice_writer = VoiceSessionWriter(VOICE_FLUSH_INTERVAL, VOICE_FLUSH_MAX_EVENTS)
+voice_writer.load()
+
+# === АРХИВ ГОЛОСОВЫХ СЕССИЙ ===
+# Закрытые сессии старше VOICE_RETENTION_DAYS переносятся пачками в archive/voice_sessions_YYYY-MM.jsonl.gz
+# (месяц — по началу сессии, UTC). Каждая пачка дописывается отдельным gzip-членом и fsync'ится
+# в рабочем потоке, и только потом строки удаляются из БД. При падении между этими шагами пачка
+# попадёт в архив повторно — читатель пропускает уже встреченные id.
+ARCHIVE_DIR = "archive"
+ARCHIVE_BATCH = 5000
+ARCHIVE_INTERVAL = 6 * 3600
+
+@adb.register
+def fetch_archivable_sessions(cutoff: int, limit: int) -> list:
+    return db.fetchall(
+        "SELECT id, user_id, channel_id, start_time, end_time FROM voice_sessions "
+        "WHERE start_time < ? AND end_time IS NOT NULL ORDER BY id LIMIT ?",
+        (cutoff, limit)
+    )
+
+@adb.register
+def delete_voice_sessions(ids: list):
+    with db.transaction() as cursor:
+        cursor.executemany("DELETE FROM voice_sessions WHERE id = ?", ((row_id,) for row_id in ids))
+
+def archive_path(month: str) -> str:
+    return os.path.join(ARCHIVE_DIR, f"voice_sessions_{month}.jsonl.gz")
+
+def append_to_archive(rows: list):
+    by_month = {}
+    for row_id, user_id, channel_id, start, end in rows:
+        record = {"id": row_id, "user_id": user_id, "channel_id": channel_id, "start": start, "end": end}
+        by_month.setdefault(from_ms(start).strftime("%Y-%m"), []).append(record)
+    for month, records in by_month.items():
+        with open(archive_path(month), "ab") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as f:
+                for record in records:
+                    f.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+            raw.flush()
+            os.fsync(raw.fileno())
+
+def iter_archived_sessions(user_id: int = None, start: int = None, end: int = None):
+    # Потоковое чтение архива для аудита: файлы вне периода не открываются, строки читаются по одной.
+    # Для отсева повторов в памяти держатся id уже отданных записей текущего месяца
+    first = from_ms(start).strftime("%Y-%m") if start is not None else None
+    last = from_ms(end).strftime("%Y-%m") if end is not None else None
+    for name in sorted(os.listdir(ARCHIVE_DIR)):
+        if not (name.startswith("voice_sessions_") and name.endswith(".jsonl.gz")):
+            continue
+        month = name[len("voice_sessions_"):-len(".jsonl.gz")]
+        if (first and month < first) or (last and month > last):
+            continue
+        seen = set()
+        with gzip.open(os.path.join(ARCHIVE_DIR, name), "rt", encoding="utf-8") as f:
+            for line in f:
+                record = json.loads(line)
+                if user_id is not None and record["user_id"] != user_id:
+                    continue
+                if (start is not None and record["end"] <= start) or (end is not None and record["start"] >= end):
+                    continue
+                if record["id"] in seen:
+                    continue
+                seen.add(record["id"])
+                yield record
+
+def summarize_archive(user_id: int) -> dict:
+    # month -> [сессий, секунд]
+    months = {}
+    for record in iter_archived_sessions(user_id):
+        entry = months.setdefault(from_ms(record["start"]).strftime("%Y-%m"), [0, 0])
+        entry[0] += 1
+        entry[1] += (record["end"] - record["start"]) // 1000
+    return months
+
+async def archive_voice_sessions() -> int:
+    cutoff = now_ms() - VOICE_RETENTION_DAYS * DAY_MS
+    archived = 0
+    while True:
+        rows = await adb.fetch_archivable_sessions(cutoff, ARCHIVE_BATCH)
+        if not rows:
+            return archived
+        # Сжатие и запись на диск — в рабочем потоке, чтобы не занимать ни цикл событий, ни поток БД
+        await asyncio.to_thread(append_to_archive, rows)
+        await adb.delete_voice_sessions([row[0] for row in rows])
+        archived += len(rows)
+
+async def voice_retention_task():
+    await bot.wait_until_ready()
+    while not bot.is_closed():
+        try:
+            archived = await archive_voice_sessions()
+            if archived:
+                print(f"🗜️ В архив перенесено голосовых сессий: {archived}")
+        except Exception as e:
+            print(f"Ошибка архивации голосовых сессий: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL)
 
 # === СОБЫТИЯ ===
 @bot.event
 async def on_ready():
     print(f'✅ Бот {bot.user} запущен!')
     print(f'💡 Отправьте "!sync" для синхронизации слэш-команд.')
+    # После переподключения объекты ролей и участников пересоздаются
+    invalidate_family_roles()
+    occupants = {}
+    for guild in bot.guilds:
+        if not guild.chunked:
+            await guild.chunk()
+        get_family_index(guild)
+        schedule_base_backup(guild)
+        for channel in guild.voice_channels + guild.stage_channels:
+            for member in channel.members:
+                if not member.bot:
+                    occupants[member.id] = channel.id
+    # Пока бот был офлайн, события голоса не приходили: сверяем открытые сессии одной пачкой
+    voice_writer.reconcile(occupants, now_ms())
+    try:
+        await voice_writer.flush()
+    except Exception as e:
+        print(f"Ошибка сверки голосовых сессий: {e}")
     bot.loop.create_task(change_status())
     bot.loop.create_task(backup_task())
 
@@ -462,22 +1659,25 @@ async def on_ready():
 async def on_voice_state_update(member, before, after):
     if member.bot:
         return
-    now = datetime.now(timezone.utc)
+    now = now_ms()
     if before.channel and not after.channel:
-        end_voice_session(member.id, now)
+        voice_writer.end_session(member.id, now)
     elif before.channel and after.channel and before.channel != after.channel:
-        end_voice_session(member.id, now)
-        add_voice_session(member.id, after.channel.id, now)
+        voice_writer.end_session(member.id, now)
+        voice_writer.start_session(member.id, after.channel.id, now)
     elif not before.channel and after.channel:
-        add_voice_session(member.id, after.channel.id, now)
+        voice_writer.start_session(member.id, after.channel.id, now)
 
 @bot.event
 async def on_member_update(before, after):
+    if before.roles != after.roles:
+        added, removed = get_family_index(after.guild).update(after)
+        await family_journal.record(after.guild.id, after.id, added, removed)
     added_roles = set(after.roles) - set(before.roles)
     if not added_roles:
         return
     roles = get_family_roles(after.guild)
-    family_role_ids = {r.id for r in roles.values() if r}
+    family_role_ids = roles.ids
     given_family_roles = [r for r in added_roles if r.id in family_role_ids]
     if not given_family_roles or not is_in_family_blacklist(after.id):
         return
@@ -498,7 +1698,7 @@ async def on_member_update(before, after):
         if issuer_roles_to_remove:
             await issuer.remove_roles(*issuer_roles_to_remove)
 
-    reason = get_blacklist_reason(after.id)
+    reason = await get_blacklist_reason(after.id)
     details = f"Участник: {after.mention} (ID: {after.id})\nПричина ЧС: {reason}"
     if issuer:
         details += f"\nВыдавший: {issuer.mention} (ID: {issuer.id})"
@@ -506,6 +1706,18 @@ async def on_member_update(before, after):
         details += f"\nСняты роли с выдавшего: {', '.join(r.name for r in issuer_roles_to_remove)}"
     await log_action(after.guild, "Попытка выдать роль участнику из ЧС", details, color=0xff0000)
 
+@bot.event
+async def on_member_join(member):
+    added, _ = get_family_index(member.guild).update(member)
+    if added:
+        await family_journal.record(member.guild.id, member.id, added, event="join")
+
+@bot.event
+async def on_member_remove(member):
+    removed = get_family_index(member.guild).remove(member.id)
+    if removed:
+        await family_journal.record(member.guild.id, member.id, removed=removed, event="leave")
+
 # === !sync ===
 @bot.command(name="sync")
 async def sync_command(ctx):
@@ -518,6 +1730,49 @@ async def sync_command(ctx):
     except Exception as e:
         await ctx.send(f"❌ Ошибка: {e}")
 
+# === !stats ===
+@bot.command(name="stats")
+async def stats_command(ctx):
+    if ctx.author.id != OWNER_ID:
+        await ctx.send("❌ Только владелец может использовать эту команду.")
+        return
+    embed = discord.Embed(title="📈 Статистика кэшей", color=0x2b2d31)
+    embed.add_field(
+        name="Конфигурация",
+        value=f"Попаданий: {config_cache.hits}\nПромахов: {config_cache.misses}\nКлючей: {len(config_cache.values)}",
+        inline=False
+    )
+    embed.add_field(
+        name="Списки",
+        value=f"ЧС семьи: {len(family_blacklist.ids)}\nВайт-лист: {len(white_list.ids)}\nБан казино: {len(casino_bans.ids)}",
+        inline=False
+    )
+    waits = economy_locks.total_wait / economy_locks.contended if economy_locks.contended else 0
+    embed.add_field(
+        name="Блокировки экономики",
+        value=(
+            f"Захватов: {economy_locks.acquired}\nС ожиданием: {economy_locks.contended}\n"
+            f"Среднее ожидание: {waits * 1000:.1f} мс\nМаксимум: {economy_locks.max_wait * 1000:.1f} мс\n"
+            f"Активных замков: {len(economy_locks.locks)}"
+        ),
+        inline=False
+    )
+    await ctx.send(embed=embed)
+
+# === !voice_audit ===
+@bot.command(name="voice_audit")
+async def voice_audit_command(ctx, user_id: int):
+    if ctx.author.id != OWNER_ID:
+        await ctx.send("❌ Только владелец может использовать эту команду.")
+        return
+    months = await asyncio.to_thread(summarize_archive, user_id)
+    if not months:
+        await ctx.send(f"🗄️ В архиве нет сессий пользователя `{user_id}`.")
+        return
+    lines = [f"**{month}** — {count} сессий, {format_duration(seconds)}" for month, (count, seconds) in sorted(months.items())]
+    embed = discord.Embed(title=f"🗄️ Архив войса: {user_id}", description="\n".join(lines[-25:]), color=0x2b2d31)
+    await ctx.send(embed=embed)
+
 # === /выдать_вайт ===
 @bot.tree.command(name="выдать_вайт", description="Добавить пользователя в вайт-лист")
 @app_commands.describe(member="Участник")
@@ -525,7 +1780,7 @@ async def give_white(interaction: discord.Interaction, member: discord.Member):
     if interaction.user.id != OWNER_ID:
         await interaction.response.send_message("❌ Эта команда доступна только владельцу бота.", ephemeral=True)
         return
-    add_to_white_list(member.id)
+    await adb.add_to_white_list(member.id)
     embed = discord.Embed(
         title="🛡️ Вайт-лист",
         description=f"Владелец {interaction.user.mention} добавил {member.mention} в вайт-лист.",
@@ -548,6 +1803,7 @@ async def on_guild_channel_update(before, after):
 
 @bot.event
 async def on_guild_role_delete(role):
+    refresh_family_roles(role.guild, role.id)
     async for entry in role.guild.audit_logs(action=discord.AuditLogAction.role_delete, limit=1):
         if entry.target.id == role.id:
             await handle_security_violation(role.guild, entry.user, "удаление роли")
@@ -555,6 +1811,9 @@ async def on_guild_role_delete(role):
 
 @bot.event
 async def on_guild_role_update(before, after):
+    # Позиция, цвет и название на состав семьи не влияют
+    if before.permissions != after.permissions:
+        refresh_family_roles(after.guild, after.id)
     if before.name != after.name or before.permissions != after.permissions or before.color != after.color:
         async for entry in after.guild.audit_logs(action=discord.AuditLogAction.role_update, limit=1):
             if entry.target.id == after.id:
@@ -567,15 +1826,14 @@ async def handle_security_violation(guild, user, action):
     if user.id == OWNER_ID or is_in_white_list(user.id):
         return
     roles = get_family_roles(guild)
-    family_role_ids = {r.id for r in roles.values() if r}
-    if not any(role.id in family_role_ids for role in user.roles):
+    if not roles.is_family(user):
         return
 
-    strikes = add_strike(user.id)
+    strikes = await adb.add_strike(user.id)
     log_channel = get_log_channel(guild)
 
     if strikes == 1:
-        roles_to_remove = [role for role in user.roles if role.id in family_role_ids]
+        roles_to_remove = roles.family_roles_of(user)
         if roles_to_remove:
             await user.remove_roles(*roles_to_remove)
         embed = discord.Embed(
@@ -639,15 +1897,21 @@ async def setup_bindings(
         await interaction.response.send_message("❌ Только владелец может использовать эту команду.", ephemeral=True)
         return
 
-    set_config("family_role_id", str(общая_роль.id))
-    set_config("leader_role_id", str(лидер.id))
-    set_config("deputy_leader_role_id", str(заместитель.id))
-    set_config("high_staff_role_id", str(high_staff.id))
-    set_config("main_staff_role_id", str(main_staff.id))
-    set_config("recruit_role_id", str(recruit.id))
-    set_config("log_channel_id", str(канал_логов.id))
-    set_config("notify_channel_id", str(канал_уведомлений.id))
-    set_config("threads_channel_id", str(канал_веток.id))
+    await adb.set_configs({
+        "family_role_id": str(общая_роль.id),
+        "leader_role_id": str(лидер.id),
+        "deputy_leader_role_id": str(заместитель.id),
+        "high_staff_role_id": str(high_staff.id),
+        "main_staff_role_id": str(main_staff.id),
+        "recruit_role_id": str(recruit.id),
+        "log_channel_id": str(канал_логов.id),
+        "notify_channel_id": str(канал_уведомлений.id),
+        "threads_channel_id": str(канал_веток.id),
+    })
+    invalidate_family_roles()
+    for guild in bot.guilds:
+        get_family_index(guild)
+        schedule_base_backup(guild)
 
     embed = discord.Embed(
         title="✅ Привязка завершена!",
@@ -684,11 +1948,10 @@ async def blacklist_family(interaction: discord.Interaction, user_id: str, reaso
         await interaction.response.send_message("❌ Пользователь не найден на сервере.", ephemeral=True)
         return
 
-    family_role_ids = {r.id for r in roles.values() if r}
-    roles_to_remove = [r for r in roles.values() if r and r in member.roles]
+    roles_to_remove = roles.family_roles_of(member)
     if roles_to_remove:
         await member.remove_roles(*roles_to_remove)
-    add_to_family_blacklist(uid, reason, interaction.user.id)
+    await adb.add_to_family_blacklist(uid, reason, interaction.user.id)
 
     await log_action(
         interaction.guild,
@@ -724,7 +1987,7 @@ async def unblacklist_family(interaction: discord.Interaction, user_id: str):
     if not is_in_family_blacklist(uid):
         await interaction.response.send_message("❌ Пользователь не в чёрном списке семьи.", ephemeral=True)
         return
-    remove_from_family_blacklist(uid)
+    await adb.remove_from_family_blacklist(uid)
     await log_action(
         interaction.guild,
         "Снятие ЧС семьи",
@@ -785,7 +2048,7 @@ async def recruitment(interaction: discord.Interaction, channel_id: str):
         @discord.ui.button(label="📄 Подать заявку", style=discord.ButtonStyle.green, emoji="📝")
         async def apply(self, inter: discord.Interaction, button: discord.ui.Button):
             if is_in_family_blacklist(inter.user.id):
-                reason = get_blacklist_reason(inter.user.id)
+                reason = await get_blacklist_reason(inter.user.id)
                 await inter.response.send_message(
                     f"❌ Вы находитесь в чёрном списке семьи.\n**Причина:** {reason}",
                     ephemeral=True
@@ -844,7 +2107,7 @@ class ApplicationModal(discord.ui.Modal, title="Заявка в ᴋᴀᴅʸʀᴏ
 
     async def on_submit(self, interaction: discord.Interaction):
         if is_in_family_blacklist(interaction.user.id):
-            reason = get_blacklist_reason(interaction.user.id)
+            reason = await get_blacklist_reason(interaction.user.id)
             await interaction.response.send_message(
                 f"❌ Вы находитесь в чёрном списке семьи.\n**Причина:** {reason}",
                 ephemeral=True
@@ -857,7 +2120,7 @@ class ApplicationModal(discord.ui.Modal, title="Заявка в ᴋᴀᴅʸʀᴏ
             )
             return
 
-        record_application(interaction.user.id)
+        await adb.record_application(interaction.user.id)
         embed = discord.Embed(
             title="📄 Новая заявка на вступление",
             color=0x2b2d31,
@@ -983,8 +2246,8 @@ async def application_status(interaction: discord.Interaction):
     if not has_any_role(interaction.user, manage_roles):
         await interaction.response.send_message("❌ У вас нет прав для просмотра статуса заявок.", ephemeral=True)
         return
-    pending_count = get_pending_applications_count()
-    last_time = get_last_application_time()
+    pending_count = await adb.get_pending_applications_count()
+    last_time = await adb.get_last_application_time()
     embed = discord.Embed(
         title="📊 Статус заявок",
         color=0xc41e3a
@@ -1003,14 +2266,6 @@ async def family_members(interaction: discord.Interaction):
         await interaction.response.send_message("❌ Эта команда доступна только участникам семьи.", ephemeral=True)
         return
 
-    rank_order = [
-        (roles["leader"], "[Лидер]"),
-        (roles["deputy_leader"], "[Заместитель Лидера]"),
-        (roles["high_staff"], "[ʜɪɢʜ sᴛᴀꜰꜰ]"),
-        (roles["main_staff"], "[ᴍᴀɪɴ sᴛᴀꜰꜰ]"),
-        (roles["recruit"], "[ʀᴇᴄʀᴜɪᴛ]")
-    ]
-
     embed = discord.Embed(
         title="👨‍👩‍👧‍👦 Состав семьи **ᴋᴀᴅʸʀᴏᴠ ꜰᴀᴍǫ**",
         color=0xc41e3a,
@@ -1024,10 +2279,9 @@ async def family_members(interaction: discord.Interaction):
         discord.Status.offline: "⚫ Не в сети"
     }
 
-    for role, rank_name in rank_order:
-        if not role:
-            continue
-        members = [m for m in role.members if not m.bot]
+    index = get_family_index(interaction.guild)
+    for role, rank_name in roles.rank_order:
+        members = index.members_with(role)
         if not members:
             continue
         members.sort(key=lambda m: m.display_name.lower())
@@ -1052,6 +2306,12 @@ async def family_members(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed)
 
 # === /состояние ===
+VOICE_TOTAL_PERIODS = (1, 7, 30)  # дней, включая сегодняшний (UTC)
+
+def format_duration(seconds: float) -> str:
+    hours, minutes = divmod(int(seconds // 60), 60)
+    return f"{hours} ч {minutes} мин"
+
 @bot.tree.command(name="состояние", description="Показать статистику пользователя по голосовым каналам")
 @app_commands.describe(user="Пользователь для проверки")
 async def user_state(interaction: discord.Interaction, user: discord.User):
@@ -1065,31 +2325,85 @@ async def user_state(interaction: discord.Interaction, user: discord.User):
     if not member:
         await interaction.response.send_message("❌ Пользователь не на сервере.", ephemeral=True)
         return
-    sessions = get_user_sessions(user.id)
-    if not sessions:
+    now = now_ms()
+    pending = voice_writer.pending_for(user.id)
+    unrolled = voice_writer.unrolled_days(user.id, now)
+    rows, totals = await adb.get_voice_overview(user.id, VOICE_TOTAL_PERIODS)
+    sessions = voice_writer.apply_pending(rows, pending)
+    # Старые сессии могли уйти в архив, а дневные итоги остались — тогда показываем только итоги
+    if not sessions and not any(totals):
         await interaction.response.send_message(f"🔇 У {user.mention} нет записей о пребывании в голосовых.", ephemeral=True)
         return
 
-    total_seconds = 0
+    # Досчитываем то, что ещё не попало в итоги: текущую сессию и незаписанные закрытия
+    today = now // DAY_MS
+    for i, period in enumerate(VOICE_TOTAL_PERIODS):
+        since = today - (period - 1)
+        totals[i] += sum(seconds for day, seconds in unrolled.items() if day >= since)
+    totals[-1] += sum(unrolled.values())
+
     details = []
-    for channel_id, start_str, end_str in sessions[:10]:
-        start = datetime.fromisoformat(start_str.replace("Z", "+00:00"))
-        end = datetime.fromisoformat((end_str or datetime.now(timezone.utc).isoformat()).replace("Z", "+00:00"))
+    for channel_id, start_ms, end_ms in sessions[:10]:
+        start = from_ms(start_ms)
+        end = from_ms(end_ms or now)
         channel = interaction.guild.get_channel(channel_id)
         name = channel.name if channel else f"ID:{channel_id}"
         duration = int((end - start).total_seconds() // 60)
-        total_seconds += (end - start).total_seconds()
         details.append(f"🎙️ **{name}** — {start.strftime('%d.%m %H:%M')} → {end.strftime('%H:%M')} ({duration} мин)")
 
-    hours, minutes = divmod(int(total_seconds // 60), 60)
     embed = discord.Embed(
         title=f"📊 Голосовая активность: {user.display_name}",
-        description=f"**Общее время:** {hours} ч {minutes} мин",
+        description=f"**Общее время:** {format_duration(totals[-1])}",
         color=0xc41e3a
     )
+    embed.add_field(name="Сегодня", value=format_duration(totals[0]), inline=True)
+    embed.add_field(name="7 дней", value=format_duration(totals[1]), inline=True)
+    embed.add_field(name="30 дней", value=format_duration(totals[2]), inline=True)
     embed.add_field(name="Последние сессии", value="\n".join(details) or "Нет данных", inline=False)
     await interaction.response.send_message(embed=embed)
 
+# === /топ_войс ===
+@bot.tree.command(name="топ_войс", description="Самые активные в голосовых каналах за период")
+@app_commands.describe(период="За какой период считать", количество="Сколько участников показать (до 25)")
+@app_commands.choices(период=[
+    app_commands.Choice(name="День", value=1),
+    app_commands.Choice(name="Неделя", value=7),
+    app_commands.Choice(name="Месяц", value=30),
+])
+async def voice_top(interaction: discord.Interaction, период: app_commands.Choice[int], количество: int = 10):
+    roles = get_family_roles(interaction.guild)
+    allowed_roles = [roles["leader"], roles["deputy_leader"]]
+    allowed_roles = [r for r in allowed_roles if r]
+    if not has_any_role(interaction.user, allowed_roles):
+        await interaction.response.send_message("❌ У вас нет прав для просмотра статистики.", ephemeral=True)
+        return
+    limit = max(1, min(количество, 25))
+    now = now_ms()
+    since = now // DAY_MS - (период.value - 1)
+    # Снимок незаписанного берётся до чтения из БД, чтобы ничего не посчиталось дважды
+    unrolled = voice_writer.unrolled_intervals(now)
+    totals = dict(await adb.get_voice_totals_since(since))
+    for user_id, start, end in unrolled:
+        extra = sum(seconds for day, seconds in split_by_day(start, end) if day >= since)
+        if extra:
+            totals[user_id] = totals.get(user_id, 0) + extra
+
+    guild = interaction.guild
+    top = heapq.nlargest(limit, ((seconds, user_id) for user_id, seconds in totals.items() if guild.get_member(user_id)))
+    if not top:
+        await interaction.response.send_message("🔇 За этот период никто не заходил в голосовые.", ephemeral=True)
+        return
+    lines = [
+        f"{place}. {guild.get_member(user_id).display_name} — {format_duration(seconds)}"
+        for place, (seconds, user_id) in enumerate(top, start=1)
+    ]
+    embed = discord.Embed(
+        title=f"🎙️ Топ войса — {период.name.lower()}",
+        description="\n".join(lines),
+        color=0xc41e3a
+    )
+    await interaction.response.send_message(embed=embed)
+
 # === /профиль ===
 @bot.tree.command(name="профиль", description="Заполнить свой профиль семьи")
 async def profile_command(interaction: discord.Interaction):
@@ -1117,7 +2431,7 @@ async def profile_command(interaction: discord.Interaction):
             self.add_item(self.static_id)
 
         async def on_submit(self, inter: discord.Interaction):
-            save_profile(inter.user.id, self.nick.value, self.static_id.value)
+            await adb.save_profile(inter.user.id, self.nick.value, self.static_id.value)
             await inter.response.send_message("✅ Ваш профиль успешно сохранён!", ephemeral=True)
 
     await interaction.response.send_modal(ProfileModal())
@@ -1130,7 +2444,7 @@ async def view_profile(interaction: discord.Interaction, member: discord.Member)
     if not roles["deputy_leader"] or roles["deputy_leader"] not in interaction.user.roles:
         await interaction.response.send_message("❌ Эта команда доступна только Заместителю Лидера.", ephemeral=True)
         return
-    profile = get_profile(member.id)
+    profile = await adb.get_profile(member.id)
     embed = discord.Embed(
         title=f"📄 Профиль: {member.display_name}",
         color=0xc41e3a
@@ -1146,30 +2460,49 @@ async def view_profile(interaction: discord.Interaction, member: discord.Member)
     await interaction.response.send_message(embed=embed)
 
 # === /восстановить_состав ===
+BACKUP_TIME_TEMPLATE = "2000-01-01_00-00-00"
+
+async def backup_date_autocomplete(interaction: discord.Interaction, current: str) -> list:
+    # Недописанное время дополняется по шаблону, из каталога берутся ближайшие снимки,
+    # а те, что начинаются с введённого, поднимаются наверх
+    current = current.strip().replace(" ", "_").replace(":", "-")
+    target = parse_backup_time(current + BACKUP_TIME_TEMPLATE[len(current):]) if current else None
+    rows = await adb.find_backups_near(interaction.guild.id, target, 25)
+    stamps = [(from_ms(taken_at).strftime("%Y-%m-%d_%H-%M-%S"), member_count) for taken_at, member_count in rows]
+    stamps.sort(key=lambda item: not item[0].startswith(current))
+    return [
+        app_commands.Choice(name=f"{stamp} UTC — {member_count} участников", value=stamp)
+        for stamp, member_count in stamps
+    ]
+
 @bot.tree.command(name="восстановить_состав", description="Восстановить состав семьи из бэкапа")
-@app_commands.describe(date="Дата бэкапа (формат: YYYY-MM-DD_HH-MM)")
+@app_commands.describe(date="Момент времени UTC (формат: YYYY-MM-DD_HH-MM)")
+@app_commands.autocomplete(date=backup_date_autocomplete)
 async def restore_backup(interaction: discord.Interaction, date: str):
     roles = get_family_roles(interaction.guild)
     if not roles["leader"] or roles["leader"] not in interaction.user.roles:
         await interaction.response.send_message("❌ Только Лидер может восстанавливать состав.", ephemeral=True)
         return
-    filepath = f"backups/backup_{date}.json"
-    if not os.path.exists(filepath):
-        files = "\n".join(f"`{f.replace('backup_', '').replace('.json', '')}`" for f in sorted(os.listdir("backups")))
-        await interaction.response.send_message(
-            f"❌ Бэкап не найден.\nДоступные даты:\n{files}",
-            ephemeral=True
-        )
+    at = parse_backup_time(date, end=True)
+    if at is None:
+        await interaction.response.send_message("❌ Неверный формат. Используйте YYYY-MM-DD_HH-MM (UTC).", ephemeral=True)
         return
-    with open(filepath, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    try:
+        result = await family_state_at(interaction.guild.id, at)
+    except ValueError as e:
+        await interaction.response.send_message(f"❌ Снимок повреждён: {e}.", ephemeral=True)
+        return
+    if result is None:
+        await interaction.response.send_message("❌ Нет базового снимка на этот момент.", ephemeral=True)
+        return
+    state, path, changes = result
     restored = 0
-    for member_data in data["members"]:
-        member = interaction.guild.get_member(member_data["user_id"])
+    for user_id, role_ids in state.items():
+        member = interaction.guild.get_member(user_id)
         if not member:
             continue
         roles_to_add = []
-        for role_id in member_data["roles"]:
+        for role_id in role_ids:
             role = interaction.guild.get_role(role_id)
             if role and role not in member.roles:
                 roles_to_add.append(role)
@@ -1181,9 +2514,219 @@ async def restore_backup(interaction: discord.Interaction, date: str):
         description=f"Восстановлено ролей для {restored} участников.",
         color=0x00ff00
     )
-    embed.add_field(name="Файл", value=f"`{date}.json`", inline=False)
+    embed.add_field(name="Снимок", value=f"`{os.path.basename(path)}`", inline=False)
+    embed.add_field(name="Применено изменений", value=str(changes), inline=False)
     await interaction.response.send_message(embed=embed)
 
+# === ПОСЛЕДОВАТЕЛЬНОЕ ВЫПОЛНЕНИЕ ЭКОНОМИКИ ===
+# Замок на каждого пользователя: его ставки, /work, покупки и выдачи выполняются по очереди,
+# а разные пользователи друг друга не ждут. Замок живёт, пока его держат или ждут,
+# и удаляется сразу после освобождения, поэтому память не растёт с числом игроков.
+class KeyedLocks:
+    def __init__(self):
+        self.locks = {}  # key -> [asyncio.Lock, число держателей и ожидающих]
+        self.acquired = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self.locks.get(key)
+        if entry is None:
+            entry = self.locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            if entry[0].locked():
+                self.contended += 1
+                started = time.perf_counter()
+                await entry[0].acquire()
+                waited = time.perf_counter() - started
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            else:
+                await entry[0].acquire()
+            self.acquired += 1
+            try:
+                yield
+            finally:
+                entry[0].release()
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.locks[key]
+
+economy_locks = KeyedLocks()
+
+# === КУЛДАУНЫ И ОГРАНИЧЕНИЕ ЧАСТОТЫ ===
+# Кулдауны (/work) и корзины токенов (казино, магазин) проверяются в памяти без обращения к БД.
+# Кулдауны раз в COOLDOWN_SAVE_INTERVAL секунд и при остановке сбрасываются в таблицу cooldowns,
+# поэтому переживают перезапуск; корзины токенов короткоживущие и не сохраняются.
+COOLDOWN_SAVE_INTERVAL = 60
+WORK_COOLDOWN = 300
+
+def format_wait(seconds: float) -> str:
+    seconds = max(1, int(seconds + 0.999))
+    minutes, seconds = divmod(seconds, 60)
+    return f"{minutes} мин {seconds} сек" if minutes else f"{seconds} сек"
+
+class TokenBucket:
+    def __init__(self, capacity: int, per_second: float):
+        self.capacity = capacity
+        self.rate = per_second
+        self.buckets = {}  # user_id -> (токены, время последнего пересчёта)
+
+    def consume(self, key) -> float:
+        # 0, если действие разрешено, иначе сколько секунд ждать следующего токена
+        now = time.monotonic()
+        tokens, stamp = self.buckets.get(key, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - stamp) * self.rate)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+        self.buckets[key] = (tokens - 1, now)
+        return 0.0
+
+    def prune(self):
+        # Корзина, которая успела наполниться, ничем не отличается от отсутствующей
+        now = time.monotonic()
+        refill = self.capacity / self.rate
+        self.buckets = {key: value for key, value in self.buckets.items() if now - value[1] < refill}
+
+casino_limiter = TokenBucket(capacity=5, per_second=0.5)
+shop_limiter = TokenBucket(capacity=3, per_second=0.2)
+
+@adb.register
+def save_cooldowns(batch: dict, now: float):
+    with db.transaction() as cursor:
+        cursor.executemany(
+            "INSERT OR REPLACE INTO cooldowns (name, user_id, expires_at) VALUES (?, ?, ?)",
+            [(name, user_id, int(expires_at * 1000)) for (name, user_id), expires_at in batch.items()]
+        )
+        cursor.execute("DELETE FROM cooldowns WHERE expires_at <= ?", (int(now * 1000),))
+
+class Cooldowns:
+    def __init__(self, interval: float, buckets: tuple = ()):
+        self.interval = interval
+        self.buckets = buckets
+        self.expires = {}  # (name, user_id) -> unix-время окончания
+        self.dirty = {}    # то же, ещё не записанное в БД
+        self.task = None
+        self.flushing = None
+
+    def load(self):
+        rows = db.fetchall("SELECT name, user_id, expires_at FROM cooldowns WHERE expires_at > ?", (now_ms(),))
+        self.expires = {(name, user_id): expires_at / 1000 for name, user_id, expires_at in rows}
+
+    def remaining(self, name: str, user_id: int) -> float:
+        left = self.expires.get((name, user_id), 0) - time.time()
+        return left if left > 0 else 0.0
+
+    def trigger(self, name: str, user_id: int, seconds: float):
+        key = (name, user_id)
+        self.expires[key] = self.dirty[key] = time.time() + seconds
+
+    def release(self, name: str, user_id: int):
+        # Откат кулдауна, если команда упала: нулевое время удалится из БД при сохранении
+        key = (name, user_id)
+        self.expires.pop(key, None)
+        self.dirty[key] = 0.0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            for bucket in self.buckets:
+                bucket.prune()
+            self.flushing = asyncio.ensure_future(self.flush())
+            try:
+                await asyncio.shield(self.flushing)
+            except Exception as e:
+                print(f"Ошибка сохранения кулдаунов: {e}")
+
+    async def flush(self):
+        now = time.time()
+        self.expires = {key: expires_at for key, expires_at in self.expires.items() if expires_at > now}
+        if not self.dirty:
+            return
+        batch, self.dirty = self.dirty, {}
+        try:
+            await adb.save_cooldowns(batch, now)
+        except Exception:
+            batch.update(self.dirty)
+            self.dirty = batch
+            raise
+
+    async def close(self):
+        await stop_flush_loop(self)
+        await self.flush()
+
+cooldowns = Cooldowns(COOLDOWN_SAVE_INTERVAL, buckets=(casino_limiter, shop_limiter))
+cooldowns.load()
+
+class CommandRejected(app_commands.CheckFailure):
+    # Текст исключения отправляется пользователю как есть
+    pass
+
+class CooldownActive(CommandRejected):
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def family_only():
+    # Ставится ниже @cooldown: проверки идут снизу вверх, и посторонний не получит кулдаун
+    async def predicate(interaction: discord.Interaction) -> bool:
+        member_role = get_family_roles(interaction.guild)["member"]
+        if not member_role or member_role not in interaction.user.roles:
+            raise CommandRejected("❌ Эта команда доступна только участникам семьи.")
+        return True
+    return app_commands.check(predicate)
+
+def cooldown(name: str, seconds: float, message: str):
+    # Проверка и запуск кулдауна идут без await между ними, поэтому двойной вызов не проскочит.
+    # Если тело команды затем упадёт, обработчик ошибок снимет кулдаун по отметке в extras.
+    async def predicate(interaction: discord.Interaction) -> bool:
+        left = cooldowns.remaining(name, interaction.user.id)
+        if left:
+            raise CooldownActive(message, left)
+        cooldowns.trigger(name, interaction.user.id, seconds)
+        interaction.extras["cooldown"] = name
+        return True
+    return app_commands.check(predicate)
+
+def rate_limit(bucket: TokenBucket, message: str = "⏳ Слишком часто!"):
+    async def predicate(interaction: discord.Interaction) -> bool:
+        wait = bucket.consume(interaction.user.id)
+        if wait:
+            raise CooldownActive(message, wait)
+        return True
+    return app_commands.check(predicate)
+
+async def reject_rate_limited(interaction: discord.Interaction, bucket: TokenBucket) -> bool:
+    # Для кнопок и меню, где декоратор команд неприменим
+    wait = bucket.consume(interaction.user.id)
+    if wait:
+        await interaction.response.send_message(f"⏳ Слишком часто! Подождите {format_wait(wait)}.", ephemeral=True)
+        return True
+    return False
+
+@bot.tree.error
+async def on_app_command_error(interaction: discord.Interaction, error: app_commands.AppCommandError):
+    # Кулдаун запускается до тела команды; неудачная попытка не должна его тратить
+    name = interaction.extras.pop("cooldown", None)
+    if name:
+        cooldowns.release(name, interaction.user.id)
+    if isinstance(error, CooldownActive):
+        await interaction.response.send_message(f"{error} Подождите {format_wait(error.retry_after)}.", ephemeral=True)
+        return
+    if isinstance(error, CommandRejected):
+        await interaction.response.send_message(str(error), ephemeral=True)
+        return
+    await app_commands.CommandTree.on_error(bot.tree, interaction, error)
+
 # === КАЗИНО ===
 # === /баланс ===
 @bot.tree.command(name="баланс", description="Показать ваш баланс в казино")
@@ -1191,46 +2734,73 @@ async def balance_command(interaction: discord.Interaction):
     if is_casino_banned(interaction.user.id):
         await interaction.response.send_message("❌ Вы забанены в казино.", ephemeral=True)
         return
-    balance = get_balance(interaction.user.id)
+    balance = await adb.get_balance(interaction.user.id)
     embed = discord.Embed(
         title="💰 Ваш баланс",
         description=f"У вас на счету: **${balance:,}**",
         color=0x2ecc71
     )
+    place, around = balance_ranking.neighbours(interaction.user.id)
+    if place:
+        names = await casino_leaderboard.resolve_names(interaction.guild, [uid for _, uid, _ in around])
+        lines = [
+            f"{'➡️ ' if uid == interaction.user.id else ''}{pos}. {names.get(uid, f'ID: {uid}')} — ${amount:,}"
+            for pos, uid, amount in around
+        ]
+        embed.add_field(name=f"Место в топе: #{place} из {len(balance_ranking)}", value="\n".join(lines), inline=False)
     await interaction.response.send_message(embed=embed)
 
-# === ВСПОМОГАТЕЛЬНАЯ ФУНКЦИЯ: создать кнопки казино ===
-def create_casino_view(user_id: int):
-    class CasinoView(discord.ui.View):
-        def __init__(self):
-            super().__init__(timeout=300)
-
-        async def interaction_check(self, interaction: discord.Interaction) -> bool:
-            if is_casino_banned(interaction.user.id):
-                await interaction.response.send_message("❌ Вы забанены в казино.", ephemeral=True)
-                return False
-            if interaction.user.id != user_id:
-                await interaction.response.send_message("❌ Эта игра не для вас.", ephemeral=True)
-                return False
-            return True
-
-        @discord.ui.button(label="🎲 Кости", style=discord.ButtonStyle.blurple, emoji="🎲")
-        async def dice_button(self, inter: discord.Interaction, button: discord.ui.Button):
-            await inter.response.send_modal(DiceModal(min_bet=1000, user_id=user_id))
-
-        @discord.ui.button(label="🎰 Слоты", style=discord.ButtonStyle.green, emoji="🎰")
-        async def slots_button(self, inter: discord.Interaction, button: discord.ui.Button):
-            await inter.response.send_modal(SlotsModal(min_bet=500, user_id=user_id))
+# === КНОПКИ КАЗИНО ===
+# Каждая кнопка — динамический элемент с custom_id вида "casino:<игра>:<id владельца>".
+# Шаблон регистрируется один раз в setup_hook, поэтому кнопки под старыми сообщениями
+# продолжают работать после таймаута вида и перезапуска бота.
+CASINO_GAMES = {
+    # игра: (подпись, стиль, эмодзи)
+    "dice": ("🎲 Кости", discord.ButtonStyle.blurple, "🎲"),
+    "slots": ("🎰 Слоты", discord.ButtonStyle.green, "🎰"),
+    "chance": ("🔮 Шанс", discord.ButtonStyle.red, "🔮"),
+    "roulette": ("🎡 Рулетка", discord.ButtonStyle.grey, "🎡"),
+}
 
-        @discord.ui.button(label="🔮 Шанс", style=discord.ButtonStyle.red, emoji="🔮")
-        async def chance_button(self, inter: discord.Interaction, button: discord.ui.Button):
-            await inter.response.send_modal(ChanceModal(min_bet=100, user_id=user_id))
+class CasinoButton(discord.ui.DynamicItem[discord.ui.Button], template=r"casino:(?P<game>dice|slots|chance|roulette):(?P<user_id>\d+)"):
+    def __init__(self, game: str, user_id: int):
+        label, style, emoji = CASINO_GAMES[game]
+        super().__init__(discord.ui.Button(label=label, style=style, emoji=emoji, custom_id=f"casino:{game}:{user_id}"))
+        self.game = game
+        self.user_id = user_id
 
-        @discord.ui.button(label="🎡 Рулетка", style=discord.ButtonStyle.grey, emoji="🎡")
-        async def roulette_button(self, inter: discord.Interaction, button: discord.ui.Button):
-            await inter.response.send_modal(RouletteModal(min_bet=1000, user_id=user_id))
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match):
+        return cls(match["game"], int(match["user_id"]))
 
-    return CasinoView()
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        if is_casino_banned(interaction.user.id):
+            await interaction.response.send_message("❌ Вы забанены в казино.", ephemeral=True)
+            return False
+        if interaction.user.id != self.user_id:
+            await interaction.response.send_message("❌ Эта игра не для вас.", ephemeral=True)
+            return False
+        return not await reject_rate_limited(interaction, casino_limiter)
+
+    async def callback(self, interaction: discord.Interaction):
+        if self.game == "dice":
+            modal = DiceModal(min_bet=casino_rules.DICE_MIN_BET, user_id=self.user_id)
+        elif self.game == "slots":
+            modal = SlotsModal(min_bet=casino_rules.SLOTS_MIN_BET, user_id=self.user_id)
+        elif self.game == "chance":
+            modal = ChanceModal(min_bet=casino_rules.CHANCE_MIN_BET, user_id=self.user_id)
+        else:
+            modal = RouletteModal(min_bet=casino_rules.ROULETTE_MIN_BET, user_id=self.user_id)
+        await interaction.response.send_modal(modal)
+
+class CasinoView(discord.ui.View):
+    # Вид нужен только чтобы отправить кнопки; нажатия обрабатывает CasinoButton,
+    # поэтому таймаут лишь убирает вид из памяти и не отключает кнопки.
+    # Раунды правят только эмбед — кнопки остаются на сообщении.
+    def __init__(self, user_id: int):
+        super().__init__(timeout=300)
+        for game in CASINO_GAMES:
+            self.add_item(CasinoButton(game, user_id))
 
 # === МОДАЛЬНЫЕ ОКНА С НОВЫМИ ШАНСАМИ ===
 class DiceModal(discord.ui.Modal, title="🎲 Кости"):
@@ -1247,23 +2817,24 @@ class DiceModal(discord.ui.Modal, title="🎲 Кости"):
         except ValueError:
             await inter.response.send_message("❌ Сумма должна быть числом.", ephemeral=True)
             return
-        if amount < self.min_bet or amount > get_balance(inter.user.id):
+        if amount < self.min_bet:
             await inter.response.send_message("❌ Неверная сумма.", ephemeral=True)
             return
-        balance = get_balance(inter.user.id)
-        set_balance(inter.user.id, balance - amount)
-        if random.random() < 0.35:  # 35%
-            prize = amount * 2
-            set_balance(inter.user.id, balance - amount + prize)
+        won, prize = casino_rules.play_dice(amount)
+        async with economy_locks.hold(inter.user.id):
+            new_balance = await adb.settle_bet(inter.user.id, amount, prize)
+        if new_balance is None:
+            await inter.response.send_message("❌ Неверная сумма.", ephemeral=True)
+            return
+        if won:
             result = f"🎉 Вы выиграли **${prize:,}**!\nВаш бросок оказался удачным!"
             color = 0x2ecc71
         else:
             result = f"💀 Вы проиграли **${amount:,}**.\nПовезёт в следующий раз!"
             color = 0xe74c3c
-        new_balance = get_balance(inter.user.id)
         embed = discord.Embed(title="🎲 Кости", description=result, color=color)
         embed.set_footer(text=f"Баланс: ${new_balance:,}")
-        await inter.response.edit_message(embed=embed, view=create_casino_view(self.user_id))
+        await inter.response.edit_message(embed=embed)
 
 class SlotsModal(discord.ui.Modal, title="🎰 Слоты"):
     def __init__(self, min_bet=500, user_id=None):
@@ -1279,37 +2850,32 @@ class SlotsModal(discord.ui.Modal, title="🎰 Слоты"):
         except ValueError:
             await inter.response.send_message("❌ Сумма должна быть числом.", ephemeral=True)
             return
-        if amount < self.min_bet or amount > get_balance(inter.user.id):
+        if amount < self.min_bet:
             await inter.response.send_message("❌ Неверная сумма.", ephemeral=True)
             return
-        balance = get_balance(inter.user.id)
-        set_balance(inter.user.id, balance - amount)
-        symbols = ["🍒", "🍋", "🍊", "🍇", "💎", "7️⃣"]
-        spin = [random.choice(symbols) for _ in range(3)]
+        spin, won, prize = casino_rules.play_slots(amount)
         spin_str = " | ".join(spin)
-        if random.random() < 0.35:  # 35%
+        async with economy_locks.hold(inter.user.id):
+            new_balance = await adb.settle_bet(inter.user.id, amount, prize)
+        if new_balance is None:
+            await inter.response.send_message("❌ Неверная сумма.", ephemeral=True)
+            return
+        if won:
             if spin[0] == spin[1] == spin[2]:
-                prize = amount * 3
-                set_balance(inter.user.id, balance - amount + prize)
                 result = f"🏆 Джекпот! Вы выиграли **${prize:,}**!\n{spin_str}"
                 color = 0x2ecc71
             elif spin[0] == spin[1] or spin[1] == spin[2] or spin[0] == spin[2]:
-                prize = amount * 2
-                set_balance(inter.user.id, balance - amount + prize)
                 result = f"👍 Два одинаковых! Вы выиграли **${prize:,}**!\n{spin_str}"
                 color = 0x3498db
             else:
-                prize = amount * 2
-                set_balance(inter.user.id, balance - amount + prize)
                 result = f"✨ Удача на вашей стороне! Вы выиграли **${prize:,}**!\n{spin_str}"
                 color = 0x2ecc71
         else:
             result = f"💔 Повезёт в следующий раз!\n{spin_str}"
             color = 0xe74c3c
-        new_balance = get_balance(inter.user.id)
         embed = discord.Embed(title="🎰 Слоты", description=result, color=color)
         embed.set_footer(text=f"Баланс: ${new_balance:,}")
-        await inter.response.edit_message(embed=embed, view=create_casino_view(self.user_id))
+        await inter.response.edit_message(embed=embed)
 
 class ChanceModal(discord.ui.Modal, title="🔮 Шанс"):
     def __init__(self, min_bet=100, user_id=None):
@@ -1325,23 +2891,24 @@ class ChanceModal(discord.ui.Modal, title="🔮 Шанс"):
         except ValueError:
             await inter.response.send_message("❌ Сумма должна быть числом.", ephemeral=True)
             return
-        if amount < self.min_bet or amount > get_balance(inter.user.id):
+        if amount < self.min_bet:
+            await inter.response.send_message("❌ Неверная сумма.", ephemeral=True)
+            return
+        won, prize = casino_rules.play_chance(amount)
+        async with economy_locks.hold(inter.user.id):
+            new_balance = await adb.settle_bet(inter.user.id, amount, prize)
+        if new_balance is None:
             await inter.response.send_message("❌ Неверная сумма.", ephemeral=True)
             return
-        balance = get_balance(inter.user.id)
-        set_balance(inter.user.id, balance - amount)
-        if random.random() < 0.35:  # 35%
-            prize = amount * 3
-            set_balance(inter.user.id, balance - amount + prize)
+        if won:
             result = f"✨ Удача на вашей стороне! Вы умножили ставку на 3!\nВыигрыш: **${prize:,}**"
             color = 0x2ecc71
         else:
             result = f"🌑 Вам не повезло. Ставка потеряна."
             color = 0xe74c3c
-        new_balance = get_balance(inter.user.id)
         embed = discord.Embed(title="🔮 Шанс", description=result, color=color)
         embed.set_footer(text=f"Баланс: ${new_balance:,}")
-        await inter.response.edit_message(embed=embed, view=create_casino_view(self.user_id))
+        await inter.response.edit_message(embed=embed)
 
 # === 🎡 РУЛЕТКА — ИСПРАВЛЕНА (x36 при точном совпадении) ===
 class RouletteModal(discord.ui.Modal, title="🎡 Рулетка"):
@@ -1384,82 +2951,154 @@ class RouletteModal(discord.ui.Modal, title="🎡 Рулетка"):
         if amount < self.min_bet:
             await inter.response.send_message(f"❌ Минимальная ставка: ${self.min_bet:,}.", ephemeral=True)
             return
-        if amount > get_balance(inter.user.id):
-            await inter.response.send_message("❌ Недостаточно средств на балансе.", ephemeral=True)
-            return
-
-        # Списываем ставку
-        balance = get_balance(inter.user.id)
-        set_balance(inter.user.id, balance - amount)
 
         # Крутим рулетку
-        bot_number = random.randint(1, 36)
+        bot_number, prize = casino_rules.play_roulette(number, amount)
+
+        # Списываем ставку и зачисляем выигрыш одной транзакцией
+        async with economy_locks.hold(inter.user.id):
+            new_balance = await adb.settle_bet(inter.user.id, amount, prize)
+        if new_balance is None:
+            await inter.response.send_message("❌ Недостаточно средств на балансе.", ephemeral=True)
+            return
 
         if number == bot_number:
-            prize = amount * 36
-            set_balance(inter.user.id, balance - amount + prize)
             result = f"🎯 **БИНГО!** Вы угадали число **{bot_number}**!\nВы выиграли **${prize:,}** (ставка ×36)!"
             color = 0x2ecc71
         else:
             result = f"🔴 Выпало число **{bot_number}**. Вы проиграли **${amount:,}**."
             color = 0xe74c3c
 
-        new_balance = get_balance(inter.user.id)
         embed = discord.Embed(title="🎡 Рулетка", description=result, color=color)
         embed.set_footer(text=f"Ваш баланс: ${new_balance:,}")
-        await inter.response.edit_message(embed=embed, view=create_casino_view(self.user_id))
+        await inter.response.edit_message(embed=embed)
 
 # === /казино ===
 @bot.tree.command(name="казино", description="Играть в казино")
+@rate_limit(casino_limiter)
 async def casino_command(interaction: discord.Interaction):
     if is_casino_banned(interaction.user.id):
         await interaction.response.send_message("❌ Вы забанены в казино.", ephemeral=True)
         return
-    balance = get_balance(interaction.user.id)
+    balance = await adb.get_balance(interaction.user.id)
     embed = discord.Embed(
         title="🎰 Казино ᴋᴀᴅʸʀᴏᴠ ꜰᴀᴍǫ",
         description=f"{interaction.user.mention}, ваш баланс: **${balance:,}**\nВыберите игру:",
         color=0x9b59b6
     )
-    await interaction.response.send_message(embed=embed, view=create_casino_view(interaction.user.id))
+    await interaction.response.send_message(embed=embed, view=CasinoView(interaction.user.id))
 
 # === /топ_казино ===
-@bot.tree.command(name="топ_казино", description="Топ-10 богачей казино")
-async def top_casino(interaction: discord.Interaction):
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    cursor.execute("SELECT user_id, balance FROM casino_balance ORDER BY balance DESC LIMIT 10")
-    top_players = cursor.fetchall()
-    conn.close()
-    if not top_players:
-        await interaction.response.send_message("Никто ещё не играл в казино.", ephemeral=True)
-        return
-    description = ""
-    for i, (user_id, balance) in enumerate(top_players, 1):
-        user = await bot.fetch_user(user_id)
-        name = user.display_name if user else f"ID: {user_id}"
-        description += f"{i}. **{name}** — ${balance:,}\n"
+# Имена берутся из кэша участников сервера, затем из таблицы user_names, и только
+# оставшиеся запрашиваются через fetch_user — параллельно. Готовые страницы живут LEADERBOARD_TTL секунд.
+# Записи user_names старше USER_NAME_TTL перезапрашиваются, а имена участников сервера обновляют их сразу.
+LEADERBOARD_PAGE_SIZE = 10
+LEADERBOARD_TTL = 30
+USER_NAME_TTL = 24 * 3600
+
+class CasinoLeaderboard:
+    def __init__(self, page_size: int, ttl: float):
+        self.page_size = page_size
+        self.ttl = ttl
+        self.pages = {}  # (guild_id, страница) -> (истекает, (строки, страница, всего страниц))
+
+    async def resolve_names(self, guild: discord.Guild, user_ids: list) -> dict:
+        now = now_ms()
+        fresh_since = now - USER_NAME_TTL * 1000
+        stored = await adb.get_user_names(user_ids) if user_ids else {}
+        names = {}
+        updates = {}
+        for user_id in user_ids:
+            member = guild.get_member(user_id) if guild else None
+            if member:
+                names[user_id] = member.display_name
+                name, fetched_at = stored.get(user_id, (None, 0))
+                if name != member.display_name or fetched_at < fresh_since:
+                    updates[user_id] = member.display_name
+        # Устаревшее имя показываем, пока не удалось получить новое
+        in_guild = set(names)
+        for user_id, (name, _) in stored.items():
+            names.setdefault(user_id, name)
+        stale = [uid for uid in user_ids if uid not in in_guild and stored.get(uid, (None, 0))[1] < fresh_since]
+        if stale:
+            results = await asyncio.gather(*(bot.fetch_user(uid) for uid in stale), return_exceptions=True)
+            fetched = {uid: user.display_name for uid, user in zip(stale, results) if not isinstance(user, Exception)}
+            names.update(fetched)
+            updates.update(fetched)
+        if updates:
+            await adb.save_user_names(updates, now)
+        return names
+
+    async def page(self, guild: discord.Guild, page: int):
+        key = (guild.id if guild else 0, page)
+        now = time.monotonic()
+        cached = self.pages.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        total_pages = max(1, -(-len(balance_ranking) // self.page_size))
+        page = min(max(page, 1), total_pages)
+        offset = (page - 1) * self.page_size
+        rows = balance_ranking.slice(offset, offset + self.page_size)
+        names = await self.resolve_names(guild, [user_id for user_id, _ in rows])
+        lines = [
+            f"{i}. **{names.get(user_id, f'ID: {user_id}')}** — ${balance:,}"
+            for i, (user_id, balance) in enumerate(rows, offset + 1)
+        ]
+        result = (lines, page, total_pages)
+        if len(self.pages) > 100:
+            self.pages = {k: v for k, v in self.pages.items() if v[0] > now}
+        self.pages[key] = (now + self.ttl, result)
+        return result
+
+casino_leaderboard = CasinoLeaderboard(LEADERBOARD_PAGE_SIZE, LEADERBOARD_TTL)
+
+def leaderboard_embed(lines: list, page: int, total_pages: int) -> discord.Embed:
     embed = discord.Embed(
-        title="🏆 Топ-10 казино",
-        description=description,
+        title="🏆 Топ казино",
+        description="\n".join(lines),
         color=0xf1c40f
     )
-    await interaction.response.send_message(embed=embed)
+    embed.set_footer(text=f"Страница {page}/{total_pages}")
+    return embed
+
+class LeaderboardView(discord.ui.View):
+    def __init__(self, page: int, total_pages: int):
+        super().__init__(timeout=120)
+        self.page = page
+        self.prev_button.disabled = page <= 1
+        self.next_button.disabled = page >= total_pages
+
+    async def show(self, inter: discord.Interaction, page: int):
+        lines, page, total_pages = await casino_leaderboard.page(inter.guild, page)
+        await inter.response.edit_message(embed=leaderboard_embed(lines, page, total_pages), view=LeaderboardView(page, total_pages))
+
+    @discord.ui.button(label="◀️", style=discord.ButtonStyle.grey)
+    async def prev_button(self, inter: discord.Interaction, button: discord.ui.Button):
+        await self.show(inter, self.page - 1)
+
+    @discord.ui.button(label="▶️", style=discord.ButtonStyle.grey)
+    async def next_button(self, inter: discord.Interaction, button: discord.ui.Button):
+        await self.show(inter, self.page + 1)
+
+@bot.tree.command(name="топ_казино", description="Топ богачей казино")
+@app_commands.describe(страница="Номер страницы (по 10 игроков)")
+async def top_casino(interaction: discord.Interaction, страница: int = 1):
+    lines, page, total_pages = await casino_leaderboard.page(interaction.guild, страница)
+    if not lines:
+        await interaction.response.send_message("Никто ещё не играл в казино.", ephemeral=True)
+        return
+    await interaction.response.send_message(
+        embed=leaderboard_embed(lines, page, total_pages),
+        view=LeaderboardView(page, total_pages)
+    )
 
 # === /work ===
 @bot.tree.command(name="work", description="Работать и получить $10,000")
+@cooldown("work", WORK_COOLDOWN, "⏳ Вы можете работать раз в 5 минут.")
+@family_only()
 async def work_command(interaction: discord.Interaction):
-    roles = get_family_roles(interaction.guild)
-    if not roles["member"] or roles["member"] not in interaction.user.roles:
-        await interaction.response.send_message("❌ Эта команда доступна только участникам семьи.", ephemeral=True)
-        return
-    if not can_work(interaction.user.id):
-        await interaction.response.send_message("⏳ Вы можете работать раз в 5 минут.", ephemeral=True)
-        return
-    current = get_balance(interaction.user.id)
-    new_balance = current + 10000
-    set_balance(interaction.user.id, new_balance)
-    update_work_time(interaction.user.id)
+    async with economy_locks.hold(interaction.user.id):
+        new_balance = await adb.settle_bet(interaction.user.id, 0, 10000)
     embed = discord.Embed(
         title="💼 Работа завершена!",
         description=f"Вы заработали **$10,000**!\nВаш новый баланс: **${new_balance:,}**",
@@ -1478,9 +3117,8 @@ async def give_money(interaction: discord.Interaction, member: discord.Member, a
     if amount <= 0:
         await interaction.response.send_message("❌ Сумма должна быть положительной.", ephemeral=True)
         return
-    current = get_balance(member.id)
-    new_balance = current + amount
-    set_balance(member.id, new_balance)
+    async with economy_locks.hold(member.id):
+        new_balance = await adb.settle_bet(member.id, 0, amount)
     embed = discord.Embed(
         title="💸 Выдача денег",
         description=f"Заместитель {interaction.user.mention} выдал **${amount:,}** участнику {member.mention}.",
@@ -1497,8 +3135,9 @@ async def reset_balance(interaction: discord.Interaction, member: discord.Member
     if not roles["deputy_leader"] or roles["deputy_leader"] not in interaction.user.roles:
         await interaction.response.send_message("❌ Эта команда доступна только Заместителю Лидера.", ephemeral=True)
         return
-    old_balance = get_balance(member.id)
-    set_balance(member.id, 0)
+    async with economy_locks.hold(member.id):
+        old_balance = await adb.get_balance(member.id)
+        await adb.set_balance(member.id, 0)
     embed = discord.Embed(
         title="⚖️ Баланс обнулён",
         description=f"Заместитель {interaction.user.mention} обнулил баланс участника {member.mention} за нарушения.",
@@ -1514,19 +3153,14 @@ async def reset_all_balances(interaction: discord.Interaction):
     if not roles["deputy_leader"] or roles["deputy_leader"] not in interaction.user.roles:
         await interaction.response.send_message("❌ Эта команда доступна только Заместителю Лидера.", ephemeral=True)
         return
-    members = get_all_family_members(interaction.guild)
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    for member in members:
-        cursor.execute("INSERT OR REPLACE INTO casino_balance (user_id, balance) VALUES (?, 10000)", (member.id,))
-    conn.commit()
-    conn.close()
+    affected, previous_total = await adb.reset_balances(list(get_family_index(interaction.guild).members))
     embed = discord.Embed(
         title="🔄 Все балансы сброшены!",
         description=f"Заместитель {interaction.user.mention} сбросил балансы всех участников семьи до **$10,000**.",
         color=0xff0000
     )
-    embed.add_field(name="Затронуто участников", value=str(len(members)), inline=False)
+    embed.add_field(name="Затронуто участников", value=str(affected), inline=False)
+    embed.add_field(name="Было на счетах", value=f"${previous_total:,}", inline=False)
     await interaction.response.send_message(embed=embed)
 
 # === /выдать_всем_деньги ===
@@ -1540,23 +3174,14 @@ async def give_money_to_all(interaction: discord.Interaction, amount: int):
     if amount <= 0:
         await interaction.response.send_message("❌ Сумма должна быть положительной.", ephemeral=True)
         return
-    members = get_all_family_members(interaction.guild)
-    conn = sqlite3.connect("voice_data.db")
-    cursor = conn.cursor()
-    for member in members:
-        cursor.execute("SELECT balance FROM casino_balance WHERE user_id = ?", (member.id,))
-        result = cursor.fetchone()
-        current = result[0] if result else 10000
-        cursor.execute("INSERT OR REPLACE INTO casino_balance (user_id, balance) VALUES (?, ?)", (member.id, current + amount))
-    conn.commit()
-    conn.close()
+    affected, total = await adb.credit_balances(list(get_family_index(interaction.guild).members), amount)
     embed = discord.Embed(
         title="💸 Массовая выдача денег",
         description=f"Заместитель {interaction.user.mention} выдал **${amount:,}** каждому участнику семьи.",
         color=0x2ecc71
     )
-    embed.add_field(name="Получателей", value=str(len(members)), inline=True)
-    embed.add_field(name="Общая сумма", value=f"${amount * len(members):,}", inline=True)
+    embed.add_field(name="Получателей", value=str(affected), inline=True)
+    embed.add_field(name="Общая сумма", value=f"${total:,}", inline=True)
     await interaction.response.send_message(embed=embed)
 
 # === /бан_казино ===
@@ -1570,7 +3195,7 @@ async def ban_casino(interaction: discord.Interaction, member: discord.Member):
     if is_casino_banned(member.id):
         await interaction.response.send_message("❌ Этот участник уже забанен в казино.", ephemeral=True)
         return
-    ban_from_casino(member.id)
+    await adb.ban_from_casino(member.id)
     embed = discord.Embed(
         title="🚫 Бан в казино",
         description=f"Заместитель {interaction.user.mention} забанил {member.mention} в казино.",
@@ -1589,7 +3214,7 @@ async def unban_casino(interaction: discord.Interaction, member: discord.Member)
     if not is_casino_banned(member.id):
         await interaction.response.send_message("❌ Этот участник не забанен в казино.", ephemeral=True)
         return
-    unban_from_casino(member.id)
+    await adb.unban_from_casino(member.id)
     embed = discord.Embed(
         title="✅ Разбан в казино",
         description=f"Заместитель {interaction.user.mention} снял бан с {member.mention} в казино.",
@@ -1618,86 +3243,118 @@ VIRT_ITEMS = {
     "150B": {"name": "150.000.000.000 ВИРТОВ на trace", "price": 50_000_000}
 }
 
-@bot.tree.command(name="магазин", description="Купить роль или вирты")
-async def shop_command(interaction: discord.Interaction):
-    balance = get_balance(interaction.user.id)
-    embed = discord.Embed(title="🛒 Магазин", description="Выберите товар:", color=0x9b59b6)
-    role_names = {
-        1461403128330190982: "ЛУДИК",
-        1461403410124374282: "АЛЬТУХА",
-        1461403437756584126: "МЕРИКРИСТМАС",
-        1461403169342099626: "ПОВЕЛИТЕЛЬ",
-        1461403469175849137: "БИГ БОСС",
-        1461403498053767219: "СУПЕР БОСС",
-        1461403526302531686: "КОРОЛЬ ПЛАНЕТЫ",
-        1461403355145572444: "ТОП 1 ФОРБС",
-        1461403584360091651: "РОЛЬ С ПРАВАМИ МОДЕРАТОРА"
-    }
-    for rid, name in role_names.items():
-        embed.add_field(name=f"🎭 {name}", value=f"${SHOP_ROLES[rid]:,}", inline=False)
-    for key, item in VIRT_ITEMS.items():
-        embed.add_field(name=f"📦 {item['name']}", value=f"${item['price']:,}", inline=False)
-
-    options = []
-    for rid in SHOP_ROLES:
-        options.append(discord.SelectOption(label=role_names[rid], value=f"role_{rid}", description=f"${SHOP_ROLES[rid]:,}"))
-    for key in VIRT_ITEMS:
-        options.append(discord.SelectOption(label=VIRT_ITEMS[key]["name"], value=f"virt_{key}", description=f"${VIRT_ITEMS[key]['price']:,}"))
-
-    class ShopView(discord.ui.View):
-        def __init__(self):
-            super().__init__(timeout=120)
-
-        @discord.ui.select(placeholder="Выберите товар", options=options)
-        async def select_callback(self, inter: discord.Interaction, select: discord.ui.Select):
-            choice = select.values[0]
-            balance = get_balance(inter.user.id)
-            if choice.startswith("role_"):
-                role_id = int(choice.split("_")[1])
-                price = SHOP_ROLES[role_id]
-                if balance < price:
-                    await inter.response.send_message("❌ Недостаточно средств!", ephemeral=True)
-                    return
-                role = inter.guild.get_role(role_id)
-                if not role:
-                    await inter.response.send_message("❌ Роль не найдена.", ephemeral=True)
-                    return
-                if role in inter.user.roles:
-                    await inter.response.send_message("❌ У вас уже есть эта роль.", ephemeral=True)
-                    return
-                set_balance(inter.user.id, balance - price)
+SHOP_ROLE_NAMES = {
+    1461403128330190982: "ЛУДИК",
+    1461403410124374282: "АЛЬТУХА",
+    1461403437756584126: "МЕРИКРИСТМАС",
+    1461403169342099626: "ПОВЕЛИТЕЛЬ",
+    1461403469175849137: "БИГ БОСС",
+    1461403498053767219: "СУПЕР БОСС",
+    1461403526302531686: "КОРОЛЬ ПЛАНЕТЫ",
+    1461403355145572444: "ТОП 1 ФОРБС",
+    1461403584360091651: "РОЛЬ С ПРАВАМИ МОДЕРАТОРА"
+}
+
+# === КАТАЛОГ МАГАЗИНА ===
+# Каталог статичен, поэтому поля embed и пункты меню собираются один раз при запуске.
+# На каждый вызов /магазин копируется только шаблон и подставляется баланс.
+class ShopCatalog:
+    def __init__(self, roles: dict, role_names: dict, virt_items: dict):
+        items = {}  # value пункта меню -> (вид, ключ, название, цена)
+        for rid, price in roles.items():
+            items[f"role_{rid}"] = ("role", rid, role_names[rid], price)
+        for key, item in virt_items.items():
+            items[f"virt_{key}"] = ("virt", key, item["name"], item["price"])
+        self.items = MappingProxyType(items)
+        self.options = tuple(
+            discord.SelectOption(label=name, value=value, description=f"${price:,}")
+            for value, (_, _, name, price) in items.items()
+        )
+        self.template = discord.Embed(title="🛒 Магазин", description="Выберите товар:", color=0x9b59b6)
+        for kind, _, name, price in items.values():
+            icon = "🎭" if kind == "role" else "📦"
+            self.template.add_field(name=f"{icon} {name}", value=f"${price:,}", inline=False)
+
+    def embed(self, balance: int) -> discord.Embed:
+        embed = self.template.copy()
+        embed.set_footer(text=f"Ваш баланс: ${balance:,}")
+        return embed
+
+shop_catalog = ShopCatalog(SHOP_ROLES, SHOP_ROLE_NAMES, VIRT_ITEMS)
+
+# Постоянный вид: один экземпляр на весь процесс, регистрируется в setup_hook,
+# поэтому меню под старыми сообщениями работает и после перезапуска.
+class ShopView(discord.ui.View):
+    def __init__(self):
+        super().__init__(timeout=None)
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return not await reject_rate_limited(interaction, shop_limiter)
+
+    @discord.ui.select(placeholder="Выберите товар", options=list(shop_catalog.options), custom_id="shop:select")
+    async def select_callback(self, inter: discord.Interaction, select: discord.ui.Select):
+        await self.purchase(inter, select.values[0])
+
+    @staticmethod
+    async def charge(user_id: int, price: int):
+        # Под замком только списание: запросы к Discord дальше идут без него,
+        # чтобы /work и казино этого игрока не ждали лимитов API
+        async with economy_locks.hold(user_id):
+            return await adb.settle_bet(user_id, price, 0)
+
+    async def purchase(self, inter: discord.Interaction, choice: str):
+        entry = shop_catalog.items.get(choice)
+        if entry is None:
+            await inter.response.send_message("❌ Товар не найден.", ephemeral=True)
+            return
+        kind, key, name, price = entry
+        if kind == "role":
+            role = inter.guild.get_role(key)
+            if not role:
+                await inter.response.send_message("❌ Роль не найдена.", ephemeral=True)
+                return
+            if role in inter.user.roles:
+                await inter.response.send_message("❌ У вас уже есть эта роль.", ephemeral=True)
+                return
+            new_balance = await self.charge(inter.user.id, price)
+            if new_balance is None:
+                await inter.response.send_message("❌ Недостаточно средств!", ephemeral=True)
+                return
+            try:
                 await inter.user.add_roles(role)
-                embed_resp = discord.Embed(title="✅ Роль получена!", description=f"Вы купили **{role.name}** за **${price:,}**.", color=0x2ecc71)
-                embed_resp.set_footer(text=f"Баланс: ${get_balance(inter.user.id):,}")
-                await inter.response.send_message(embed=embed_resp)
-            elif choice.startswith("virt_"):
-                key = choice.split("_", 1)[1]  # защита от подчёркиваний в названии
-                if key not in VIRT_ITEMS:
-                    await inter.response.send_message("❌ Товар не найден.", ephemeral=True)
-                    return
-                item = VIRT_ITEMS[key]
-                price = item["price"]
-                if balance < price:
-                    await inter.response.send_message("❌ Недостаточно средств!", ephemeral=True)
-                    return
-                set_balance(inter.user.id, balance - price)
-                notify_channel = get_notify_channel(inter.guild)
-                if notify_channel:
-                    item_embed = discord.Embed(
-                        title="📦 Заказ виртов",
-                        description=f"**Покупатель:** {inter.user.mention}\n**Товар:** {item['name']}\n**Сумма:** ${price:,}",
-                        color=0x2ecc71
-                    )
-                    await notify_channel.send(embed=item_embed)
-                embed_resp = discord.Embed(
-                    title="✅ Заказ принят!",
-                    description=f"Ваш заказ **{item['name']}** отправлен модераторам.",
+            except discord.HTTPException:
+                async with economy_locks.hold(inter.user.id):
+                    await adb.settle_bet(inter.user.id, 0, price)
+                await inter.response.send_message("❌ Не удалось выдать роль, деньги возвращены.", ephemeral=True)
+                return
+            embed_resp = discord.Embed(title="✅ Роль получена!", description=f"Вы купили **{role.name}** за **${price:,}**.", color=0x2ecc71)
+            embed_resp.set_footer(text=f"Баланс: ${new_balance:,}")
+            await inter.response.send_message(embed=embed_resp)
+        else:
+            new_balance = await self.charge(inter.user.id, price)
+            if new_balance is None:
+                await inter.response.send_message("❌ Недостаточно средств!", ephemeral=True)
+                return
+            notify_channel = get_notify_channel(inter.guild)
+            if notify_channel:
+                item_embed = discord.Embed(
+                    title="📦 Заказ виртов",
+                    description=f"**Покупатель:** {inter.user.mention}\n**Товар:** {name}\n**Сумма:** ${price:,}",
                     color=0x2ecc71
                 )
-                embed_resp.set_footer(text=f"Баланс: ${get_balance(inter.user.id):,}")
-                await inter.response.send_message(embed=embed_resp)
+                await notify_channel.send(embed=item_embed)
+            embed_resp = discord.Embed(
+                title="✅ Заказ принят!",
+                description=f"Ваш заказ **{name}** отправлен модераторам.",
+                color=0x2ecc71
+            )
+            embed_resp.set_footer(text=f"Баланс: ${new_balance:,}")
+            await inter.response.send_message(embed=embed_resp)
 
-    await interaction.response.send_message(embed=embed, view=ShopView())
+@bot.tree.command(name="магазин", description="Купить роль или вирты")
+async def shop_command(interaction: discord.Interaction):
+    balance = await adb.get_balance(interaction.user.id)
+    await interaction.response.send_message(embed=shop_catalog.embed(balance), view=bot.shop_view)
 
 # === /мп ===
 @bot.tree.command(name="мп", description="Массовое перемещение всех из войсов + спам в ЛС")
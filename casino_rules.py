@@ -0,0 +1,49 @@
+# === ПРАВИЛА ИГР КАЗИНО ===
+# Чистые функции без Discord и БД: по ставке и генератору случайных чисел возвращают исход раунда.
+# Их используют модальные окна в bot.py, а константы — офлайн-симулятор casino_sim.py.
+import random
+
+DICE_MIN_BET = 1000
+DICE_WIN_CHANCE = 0.35
+DICE_MULTIPLIER = 2
+
+SLOTS_MIN_BET = 500
+SLOTS_WIN_CHANCE = 0.35
+SLOTS_SYMBOLS = ["🍒", "🍋", "🍊", "🍇", "💎", "7️⃣"]
+SLOTS_JACKPOT_MULTIPLIER = 3
+SLOTS_WIN_MULTIPLIER = 2
+
+CHANCE_MIN_BET = 100
+CHANCE_WIN_CHANCE = 0.35
+CHANCE_MULTIPLIER = 3
+
+ROULETTE_MIN_BET = 1000
+ROULETTE_NUMBERS = 36
+ROULETTE_MULTIPLIER = 36
+
+def play_dice(amount: int, rng=random):
+    # -> (выигрыш?, выплата)
+    won = rng.random() < DICE_WIN_CHANCE
+    return won, amount * DICE_MULTIPLIER if won else 0
+
+def play_slots(amount: int, rng=random):
+    # -> (символы, выигрыш?, выплата)
+    spin = [rng.choice(SLOTS_SYMBOLS) for _ in range(3)]
+    won = rng.random() < SLOTS_WIN_CHANCE
+    if won and spin[0] == spin[1] == spin[2]:
+        prize = amount * SLOTS_JACKPOT_MULTIPLIER
+    elif won:
+        prize = amount * SLOTS_WIN_MULTIPLIER
+    else:
+        prize = 0
+    return spin, won, prize
+
+def play_chance(amount: int, rng=random):
+    # -> (выигрыш?, выплата)
+    won = rng.random() < CHANCE_WIN_CHANCE
+    return won, amount * CHANCE_MULTIPLIER if won else 0
+
+def play_roulette(number: int, amount: int, rng=random):
+    # -> (выпавшее число, выплата)
+    bot_number = rng.randint(1, ROULETTE_NUMBERS)
+    return bot_number, amount * ROULETTE_MULTIPLIER if number == bot_number else 0
@@ -0,0 +1,131 @@
+# === ОФЛАЙН-СИМУЛЯТОР КАЗИНО ===
+# Монте-Карло по правилам из casino_rules.py: RTP, дисперсия, вероятность разорения и скорость.
+# Боту не нужен, запускается отдельно: pip install -r requirements-dev.txt && python casino_sim.py --rounds 5000000
+import argparse
+import random
+import time
+
+import numpy as np
+
+import casino_rules
+
+START_BALANCE = 10000
+ROULETTE_PICK = 7
+CHUNK = 1_000_000
+
+# --- векторизованные правила: множитель выплаты на единицу ставки ---
+def dice_multipliers(rng, n):
+    return np.where(rng.random(n) < casino_rules.DICE_WIN_CHANCE, casino_rules.DICE_MULTIPLIER, 0)
+
+def slots_multipliers(rng, n):
+    # Порядок как в play_slots: сначала барабаны, потом бросок на выигрыш
+    spin = rng.integers(0, len(casino_rules.SLOTS_SYMBOLS), (n, 3))
+    won = rng.random(n) < casino_rules.SLOTS_WIN_CHANCE
+    jackpot = (spin[:, 0] == spin[:, 1]) & (spin[:, 1] == spin[:, 2])
+    mult = np.where(jackpot, casino_rules.SLOTS_JACKPOT_MULTIPLIER, casino_rules.SLOTS_WIN_MULTIPLIER)
+    return np.where(won, mult, 0)
+
+def chance_multipliers(rng, n):
+    return np.where(rng.random(n) < casino_rules.CHANCE_WIN_CHANCE, casino_rules.CHANCE_MULTIPLIER, 0)
+
+def roulette_multipliers(rng, n):
+    hit = rng.integers(1, casino_rules.ROULETTE_NUMBERS + 1, n) == ROULETTE_PICK
+    return np.where(hit, casino_rules.ROULETTE_MULTIPLIER, 0)
+
+GAMES = {
+    "dice": (dice_multipliers, casino_rules.DICE_MIN_BET),
+    "slots": (slots_multipliers, casino_rules.SLOTS_MIN_BET),
+    "chance": (chance_multipliers, casino_rules.CHANCE_MIN_BET),
+    "roulette": (roulette_multipliers, casino_rules.ROULETTE_MIN_BET),
+}
+
+# --- скалярные правила: тот же раунд через функции бота ---
+def reference_multiplier(game, rng):
+    if game == "dice":
+        return casino_rules.play_dice(1, rng)[1]
+    if game == "slots":
+        return casino_rules.play_slots(1, rng)[2]
+    if game == "chance":
+        return casino_rules.play_chance(1, rng)[1]
+    return casino_rules.play_roulette(ROULETTE_PICK, 1, rng)[1]
+
+# --- статистика ---
+def house_edge(game, rng, rounds):
+    # Считаем по кускам, чтобы миллионы раундов не держать в памяти целиком
+    func, _ = GAMES[game]
+    total = total_sq = hits = 0
+    done = 0
+    while done < rounds:
+        n = min(CHUNK, rounds - done)
+        mult = func(rng, n).astype(np.float64)
+        total += mult.sum()
+        total_sq += (mult * mult).sum()
+        hits += np.count_nonzero(mult)
+        done += n
+    rtp = total / rounds
+    variance = total_sq / rounds - rtp * rtp
+    return {"rtp": rtp, "variance": variance, "std": variance ** 0.5, "hit_rate": hits / rounds}
+
+def ruin_curve(game, rng, players, horizon, checkpoints=10):
+    # Доля игроков, которые не могут сделать минимальную ставку к раунду t
+    func, stake = GAMES[game]
+    balance = np.full(players, START_BALANCE, dtype=np.int64)
+    ruined_at = np.full(players, -1, dtype=np.int64)
+    step = max(1, CHUNK // players)
+    marks = sorted({max(1, horizon * i // checkpoints) for i in range(1, checkpoints + 1)})
+    curve = []
+    t = 0
+    while t < horizon:
+        n = min(step, horizon - t)
+        delta = (func(rng, players * n).reshape(players, n) - 1) * stake
+        path = balance[:, None] + np.cumsum(delta, axis=1)
+        alive = ruined_at < 0
+        below = path < stake
+        first = np.where(below.any(axis=1), below.argmax(axis=1), -1)
+        newly = alive & (first >= 0)
+        ruined_at[newly] = t + first[newly] + 1
+        balance = path[:, -1]
+        t += n
+        for mark in marks:
+            if t - n < mark <= t:
+                curve.append((mark, np.count_nonzero((ruined_at > 0) & (ruined_at <= mark)) / players))
+    return curve
+
+def benchmark(game, rng, seed, rounds):
+    func, _ = GAMES[game]
+    start = time.perf_counter()
+    func(rng, rounds)
+    vectorized = rounds / (time.perf_counter() - start)
+
+    py_rounds = max(1, rounds // 100)
+    py_rng = random.Random(seed)
+    start = time.perf_counter()
+    total = sum(reference_multiplier(game, py_rng) for _ in range(py_rounds))
+    scalar = py_rounds / (time.perf_counter() - start)
+    return vectorized, scalar, total / py_rounds
+
+def main():
+    parser = argparse.ArgumentParser(description="Монте-Карло симулятор игр казино")
+    parser.add_argument("--rounds", type=int, default=2_000_000, help="раундов на игру для RTP")
+    parser.add_argument("--players", type=int, default=10_000, help="игроков для кривой разорения")
+    parser.add_argument("--horizon", type=int, default=500, help="раундов на игрока")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--games", nargs="+", choices=list(GAMES), default=list(GAMES))
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    for game in args.games:
+        stats = house_edge(game, rng, args.rounds)
+        print(f"=== {game} (мин. ставка {GAMES[game][1]}) ===")
+        print(f"RTP: {stats['rtp']:.4f} | преимущество казино: {1 - stats['rtp']:+.4f}")
+        print(f"Дисперсия: {stats['variance']:.4f} | σ: {stats['std']:.4f} | частота выигрыша: {stats['hit_rate']:.4f}")
+
+        curve = ruin_curve(game, rng, args.players, args.horizon)
+        print("Разорение (раунд: доля игроков): " + ", ".join(f"{t}: {p:.3f}" for t, p in curve))
+
+        vectorized, scalar, reference_rtp = benchmark(game, rng, args.seed, min(args.rounds, CHUNK))
+        print(f"Скорость: numpy {vectorized:,.0f} р/с | casino_rules {scalar:,.0f} р/с | RTP по casino_rules: {reference_rtp:.4f}")
+        print()
+
+if __name__ == "__main__":
+    main()